@@ -1,60 +1,347 @@
 import os
 import json
-from tqdm import tqdm
-import numpy as np
-from msa_pair.data import (
-    species_processing, row_processing, pairing_pipeline,
-)
-import esm
 
 
-msa_transformer, msa_alphabet = esm.pretrained.esm_msa1b_t12_100M_UR50S()
-msa_batch_converter = msa_alphabet.get_batch_converter()
+# the MSA Transformer is loaded on first use, and the msa_pair modules are
+# imported where they are used, so that stages which do not score (row
+# pairing, feature building) do not pay for importing torch/esm, and
+# importing this module stays cheap
+_msa_model = None
 
-def compute_scores(input_dir, dst_path, tag, max_num_msas, is_cpu=False):
-    from msa_pair.data import esm_scoring
+def load_msa_transformer(model_path=None, mmap=False):
+    """Load the MSA Transformer once per process.
+    Args:
+        model_path: local checkpoint of esm_msa1b_t12_100M_UR50S. Defaults to
+            $ESMPAIR_MODEL_PATH, then to the torch hub download.
+        mmap: memory-map the checkpoint instead of reading it into memory.
+            Defaults to $ESMPAIR_MODEL_MMAP=1.
+    """
+    global _msa_model
+    if _msa_model is None:
+        import esm
+        import torch
 
-    species_dict, msas_dict, _, _ = species_processing.pair_species(
-        input_dir, names=['uniref90.a3m'], chain_ids=['A', 'B']
-        # input_dir, names=['uniprot.a3m'], chain_ids=['A', 'B']
+        model_path = model_path or os.environ.get('ESMPAIR_MODEL_PATH')
+        mmap = mmap or os.environ.get('ESMPAIR_MODEL_MMAP') == '1'
+        if model_path is None:
+            msa_transformer, msa_alphabet = \
+                esm.pretrained.esm_msa1b_t12_100M_UR50S()
+        else:
+            # ESM checkpoints pickle their args as an argparse.Namespace, which
+            # the weights_only loader refuses; the checkpoint is a local file
+            model_data = torch.load(
+                model_path, map_location='cpu', mmap=mmap, weights_only=False
+            )
+            msa_transformer, msa_alphabet = \
+                esm.pretrained.load_model_and_alphabet_core(
+                    'esm_msa1b_t12_100M_UR50S', model_data
+                )
+        _msa_model = (msa_transformer, msa_alphabet.get_batch_converter())
+    return _msa_model
+
+def parse_target(input_dir, save_parsed=False, stream=False,
+                 names=['uniref90.a3m'], species_source='uniref'):
+    """Parse the MSAs of a target once. With save_parsed, the parsed MSAs are
+    kept in input_dir as a npz file that is loaded on the next call.
+    With stream, only the rows used by scoring are kept; row_index then maps
+    them back to the rows of the full MSA, and is None otherwise.
+    Args:
+        names: a3m files of each chain, e.g. ['uniprot.a3m'] with
+            species_source 'uniprot'
+        species_source: header convention of the a3m files, see
+            species_processing.get_species_ids
+    """
+    from msa_pair.data import species_processing
+
+    parsed_stem = os.path.splitext(names[0])[0] + '_parsed'
+    parsed_name = f'{parsed_stem}_stream.npz' if stream else f'{parsed_stem}.npz'
+    parsed_path = os.path.join(input_dir, parsed_name) if save_parsed else None
+    species_dict, msas_dict, msa_feats_dict, _ = species_processing.pair_species(
+        input_dir, names=names, chain_ids=['A', 'B'],
+        parsed_path=parsed_path,
+        species_source=species_source,
+        take_num_seqs=128 if stream else None,
+        # scoring and row pairing only group species, so keep features small
+        compact=True,
         )
-    esm_scorer = esm_scoring.EsmScoring(msa_transformer, msa_batch_converter, tag)
-    sequences_scores = esm_scorer.score_sequences(species_dict, msas_dict, max_num_msas=max_num_msas)
-    with open(dst_path, 'wt') as fh:
-        json.dump(sequences_scores, fh, indent=4, sort_keys=True)
+    row_index = None
+    if stream:
+        row_index = {
+            chain_id: msa_feat['msa_row_index']
+            for chain_id, msa_feat in msa_feats_dict.items()
+        }
+    return species_dict, msas_dict, row_index
 
 
-def pair_rows(input_dir, src_score_path, dst_pr_path, tag, overwrite=False):
+def a3m_hash(input_dir, chain_id, names=['uniref90.a3m']):
+    """Content hash of the a3m files of a chain"""
+    from msa_pair.data import score_cache as score_cache_lib
+
+    return '-'.join(
+        score_cache_lib.hash_file(os.path.join(input_dir, chain_id, name))
+        for name in names
+    )
 
 
-    with open(src_score_path) as fh:
-        sequences_scores = json.load(fh)
+def compute_scores(input_dir, dst_path, tag, max_num_msas, is_cpu=False, batch_size=1,
+                   stack_chains=False, cache_path=None, cache_size_bytes=1 << 30,
+                   parsed=None, precision='fp32', num_layers=None, packing='greedy',
+                   depth_normalize=False, stable=False, incremental=False,
+                   embedding_store_path=None, model_path=None, mmap=False,
+                   names=['uniref90.a3m'], species_source='uniref'):
+    """Score the rows of a target and save them to dst_path. With incremental
+    or stable, the species and rows of every scored block are saved next to
+    it, see manifest_path.
+    Args:
+        parsed: (species_dict, msas_dict, row_index) of the target if it has
+            already been parsed, e.g. by a parsing worker
+        stable: score every species on its own, see EsmScoring.score_sequences
+        incremental: keep the scores of the blocks of an existing dst_path
+            whose species still have the same sequences, by description, and
+            only score the other species
+        embedding_store_path: EmbeddingStore of the row embeddings of the
+            'sim' scores, shared across targets
+        model_path, mmap: see load_msa_transformer
+        names, species_source: see parse_target
+    """
+    from msa_pair.data import esm_scoring, row_processing
+    from msa_pair.data import score_cache as score_cache_lib
+    from msa_pair.data import embedding_store as embedding_store_lib
 
-    species_dict, msas_dict, _, _ = species_processing.pair_species(
-        input_dir, names=['uniref90.a3m'], chain_ids=['A', 'B']
-        # input_dir, names=['uniprot.a3m'], chain_ids=['A', 'B']
+    if parsed is None:
+        parsed = parse_target(
+            input_dir, names=names, species_source=species_source
+        )
+    species_dict, msas_dict, row_index = parsed
+    a3m_hashes = None
+    if cache_path is not None or incremental or stable:
+        # only the score cache and the manifest use the a3m hashes
+        a3m_hashes = {
+            chain_id: a3m_hash(input_dir, chain_id, names)
+            for chain_id in msas_dict
+        }
+    score_cache, msa_hashes = None, None
+    if cache_path is not None:
+        score_cache = score_cache_lib.ScoreCache(
+            cache_path, max_size_bytes=cache_size_bytes
+        )
+        msa_hashes = a3m_hashes
+        if row_index is not None:
+            # block rows index the streamed MSA, so key on the kept rows too
+            msa_hashes = {
+                chain_id: f'{msa_hash}-{score_cache_lib.hash_rows(row_index[chain_id])}'
+                for chain_id, msa_hash in msa_hashes.items()
+            }
+    msa_transformer, msa_batch_converter = load_msa_transformer(
+        model_path=model_path, mmap=mmap
     )
+    embedding_store = None
+    if embedding_store_path is not None and tag == 'sim':
+        embedding_store = embedding_store_lib.EmbeddingStore(
+            embedding_store_path, msa_transformer.args.embed_dim
+        )
+    esm_scorer = esm_scoring.EsmScoring(
+        msa_transformer, msa_batch_converter, tag, precision=precision,
+        num_layers=num_layers, embedding_store=embedding_store,
+    )
+    esm_scorer.set_device(is_cpu)
+    options = {
+        'tag': tag,
+        'max_num_msas': max_num_msas,
+        'precision': precision,
+        'num_layers': num_layers,
+        'packing': packing,
+        'depth_normalize': depth_normalize,
+        'stable': stable,
+    }
+    reused = None
+    if incremental:
+        reused = _reusable_scores(
+            dst_path, options, msas_dict, row_index,
+            esm_scorer._build_msa_blocks(species_dict, msas_dict),
+        )
+    if reused is not None:
+        reused_scores, reused_blocks, reused_species = reused
+        species_dict = {
+            spec: dfs for spec, dfs in species_dict.items()
+            if spec not in reused_species
+        }
+    block_manifest = []
+    sequences_scores = esm_scorer.score_sequences(
+        species_dict, msas_dict, max_num_msas=max_num_msas,
+        batch_size=batch_size, stack_chains=stack_chains,
+        score_cache=score_cache, msa_hashes=msa_hashes,
+        packing=packing, depth_normalize=depth_normalize,
+        stable=stable, block_manifest=block_manifest,
+    )
+    if score_cache is not None:
+        score_cache.close()
+    if embedding_store is not None:
+        embedding_store.flush()
+    if reused is not None:
+        # new blocks are numbered after the kept ones
+        offset = max((block['block_num'] for block in reused_blocks), default=0)
+        for chain_id, chain_scores in sequences_scores.items():
+            for result in chain_scores.values():
+                if result['block_num'] > 0:
+                    result['block_num'] += offset
+            chain_scores.update(reused_scores[chain_id])
+        for block in block_manifest:
+            block['block_num'] += offset
+        block_manifest = reused_blocks + block_manifest
+    if row_index is not None:
+        sequences_scores = {
+            chain_id: {
+                str(int(row_index[chain_id][int(r)])): result
+                for r, result in chain_scores.items()
+            } for chain_id, chain_scores in sequences_scores.items()
+        }
+        for block in block_manifest:
+            block['rows'] = {
+                chain_id: [int(row_index[chain_id][r]) for r in rows]
+                for chain_id, rows in block['rows'].items()
+            }
+    row_processing.save_scores(dst_path, sequences_scores)
+    if not (incremental or stable):
+        # a manifest of earlier scores would no longer match them
+        if os.path.exists(manifest_path(dst_path)):
+            os.remove(manifest_path(dst_path))
+        return
+    with open(manifest_path(dst_path), 'wt') as fh:
+        json.dump({
+            **options,
+            'a3m_hashes': a3m_hashes,
+            'blocks': block_manifest,
+        }, fh, separators=(',', ':'))
+
+
+def manifest_path(score_path):
+    """Path of the block manifest saved with the scores at score_path"""
+    return os.path.splitext(score_path)[0] + '_blocks.json'
+
+
+def scores_outdated(input_dir, score_path, names=['uniref90.a3m']):
+    """Whether the a3m files of a target changed since its scores were
+    computed. Scores without a manifest, i.e. not computed with incremental
+    or stable, are taken as up to date.
+    """
+    if not os.path.exists(manifest_path(score_path)):
+        return False
+    with open(manifest_path(score_path)) as fh:
+        a3m_hashes = json.load(fh).get('a3m_hashes', {})
+    return any(
+        a3m_hash(input_dir, chain_id, names) != hash_
+        for chain_id, hash_ in a3m_hashes.items()
+    )
+
+
+def _reusable_scores(score_path, options, msas_dict, row_index, msa_blocks):
+    """Scores of a previous run at score_path that are still valid. A block
+    is kept if it was scored with the same options and its species have the
+    same sequences, by description and in the same order, in the new MSAs.
+    Returns:
+        (scores by chain and row of msas_dict, kept blocks, kept species),
+        or None if nothing can be kept
+    """
+    from msa_pair.data import row_processing
+
+    if not (os.path.exists(score_path) and os.path.exists(manifest_path(score_path))):
+        return None
+    old_scores = row_processing.load_scores(score_path)
+    with open(manifest_path(score_path)) as fh:
+        old_manifest = json.load(fh)
+    if any(old_manifest.get(k) != v for k, v in options.items()):
+        return None
+    if set(old_scores) != set(msas_dict) or any(
+        old_scores[chain_id]['0']['description'] != str(msa.descriptions[0])
+        for chain_id, msa in msas_dict.items()
+    ):
+        return None
+
+    def _description(chain_id, r):
+        return str(msas_dict[chain_id].descriptions[r]).split()[0]
+
+    def _match_block(block, specs):
+        """Old row by new row of each chain, None if the descriptions or their
+        order in the block differ, since the rows of a block are position
+        embedded in MSA order
+        """
+        matched = {}
+        for chain_id in msas_dict:
+            old_rows = sorted(r for r in block['rows'].get(chain_id, []) if r != 0)
+            new_rows = sorted(
+                int(r) for spec in specs
+                for r in msa_blocks[spec].get_rows()[chain_id]
+            )
+            if [
+                old_scores[chain_id][str(r)]['description'] for r in old_rows
+            ] != [_description(chain_id, r) for r in new_rows]:
+                return None
+            matched[chain_id] = dict(zip(new_rows, old_rows))
+        return matched
+
+    reused_scores = {chain_id: {} for chain_id in msas_dict}
+    reused_blocks, reused_species = [], set()
+    for block in old_manifest['blocks']:
+        specs = [spec.encode() for spec in block['species']]
+        if not all(spec in msa_blocks for spec in specs):
+            continue
+        matched = _match_block(block, specs)
+        if matched is None:
+            continue
+        for chain_id, rows in matched.items():
+            for r, old_r in rows.items():
+                reused_scores[chain_id][str(r)] = old_scores[chain_id][str(old_r)]
+        reused_blocks.append({
+            **block,
+            'rows': {
+                chain_id: [0] + sorted(rows) for chain_id, rows in matched.items()
+            },
+        })
+        reused_species.update(specs)
+    if not reused_blocks:
+        return None
+    return reused_scores, reused_blocks, reused_species
+
+
+def pair_rows(input_dir, src_score_path, dst_pr_path, tag, overwrite=False,
+              parsed=None, names=['uniref90.a3m'], species_source='uniref'):
+    from msa_pair.data import row_processing
+
+    sequences_scores = row_processing.load_scores(src_score_path)
+
+    if parsed is None:
+        parsed = parse_target(
+            input_dir, names=names, species_source=species_source
+        )
+    species_dict, msas_dict, row_index = parsed
     paired_rows_dict = row_processing.create_paired_rows_dict(
         species_dict, msas_dict, sequences_scores
     )
+    if row_index is not None:
+        paired_rows_dict = {
+            chain_id: [int(row_index[chain_id][r]) for r in rows]
+            for chain_id, rows in paired_rows_dict.items()
+        }
     # print(paired_rows_dict)
     # print(paired_rows_dict["A"])
     # print(paired_rows_dict["A"][:10])
     # print(paired_rows_dict["B"][:10])
     # exit()
 
-    with open(dst_pr_path, 'wt') as fh:
-        json.dump(paired_rows_dict, fh, indent=4)
+    row_processing.save_paired_rows(dst_pr_path, paired_rows_dict)
 
 
 def process(input_dir, src_pr_path, dst_path, overwrite=False):
     if not overwrite and os.path.exists(dst_path):
         return
 
+    import numpy as np
+    from msa_pair.data import pairing_pipeline, row_processing
+
     pipeline = pairing_pipeline.PairingPipeline()
 
-    with open(src_pr_path) as fh:
-        paired_rows_dict = json.load(fh)
+    paired_rows_dict = row_processing.load_paired_rows(src_pr_path)
 
     try:
         np_example = pipeline.process(input_dir, paired_rows_dict)
@@ -64,10 +351,123 @@ def process(input_dir, src_pr_path, dst_path, overwrite=False):
 
     np.savez(dst_path, **np_example)
 
+def run_target(input_dir, tag, max_num_msas, save_parsed=False, stream=False,
+               incremental=False, fmt='json', names=['uniref90.a3m'],
+               species_source='uniref', **score_kwargs):
+    """Score and pair the rows of a target, parsing its MSAs only once.
+    With incremental, targets whose a3m files changed since they were scored
+    are rescored incrementally and paired again.
+    Args:
+        fmt: 'json' or 'npz', the format of the score and paired rows files
+        names, species_source: see parse_target
+    """
+    score_path = os.path.join(input_dir, f'{tag}_scores_{max_num_msas}.{fmt}')
+    pr_path = os.path.join(input_dir, f'{tag}_pr_{max_num_msas}.{fmt}')
+    rescore = incremental and os.path.exists(score_path) and \
+        scores_outdated(input_dir, score_path, names)
+    if os.path.exists(score_path) and os.path.exists(pr_path) and not rescore:
+        return
+
+    parsed = parse_target(
+        input_dir, save_parsed=save_parsed, stream=stream, names=names,
+        species_source=species_source,
+    )
+    if not os.path.exists(score_path) or rescore:
+        compute_scores(
+            input_dir, score_path, tag, max_num_msas, parsed=parsed,
+            incremental=incremental, names=names, **score_kwargs
+        )
+    if not os.path.exists(pr_path) or rescore:
+        pair_rows(input_dir, score_path, pr_path, tag, parsed=parsed)
+
+
+def run_parallel(input_root, tag, max_num_msas, num_workers, prefetch=None,
+                 save_parsed=False, stream=False, incremental=False, fmt='json',
+                 names=['uniref90.a3m'], species_source='uniref', **score_kwargs):
+    """Run scoring and row pairing over all targets in input_root.
+    Parsing runs in a pool of num_workers processes, while this process owns
+    the model and scores and pairs the targets in the order their parsing
+    finishes, so that each parsed target is sent between processes only
+    once. At most prefetch parsed targets are kept in flight. Targets that
+    fail, e.g. on a malformed a3m file, are skipped and returned.
+    With incremental, targets whose a3m files changed are rescored too.
+    fmt is the format of the score and paired rows files, 'json' or 'npz'.
+    names and species_source select the a3m files, see parse_target.
+    """
+    import multiprocessing
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    prefetch = prefetch or 2 * num_workers
+    to_score, to_pair = [], []
+    for name in sorted(os.listdir(input_root)):
+        input_dir = os.path.join(input_root, name)
+        score_path = os.path.join(input_dir, f'{tag}_scores_{max_num_msas}.{fmt}')
+        pr_path = os.path.join(input_dir, f'{tag}_pr_{max_num_msas}.{fmt}')
+        if not os.path.exists(score_path) or (
+            incremental and scores_outdated(input_dir, score_path, names)
+        ):
+            to_score.append((input_dir, score_path, pr_path))
+        elif not os.path.exists(pr_path):
+            to_pair.append((input_dir, score_path, pr_path))
+
+    err_dirs = []
+    # spawn, so that workers never inherit the model or a CUDA context
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(num_workers, mp_context=mp_context) as pool:
+        pair_futures = [
+            (input_dir, pool.submit(
+                pair_rows, input_dir, score_path, pr_path, tag,
+                names=names, species_source=species_source,
+            )) for input_dir, score_path, pr_path in to_pair
+        ]
+        pending = iter(to_score)
+        parse_futures = deque()
+        def _submit_parse():
+            target = next(pending, None)
+            if target is not None:
+                parse_futures.append(
+                    (target, pool.submit(
+                        parse_target, target[0], save_parsed, stream,
+                        names, species_source,
+                    ))
+                )
+
+        for _ in range(prefetch):
+            _submit_parse()
+        progress = tqdm(total=len(to_score))
+        while parse_futures:
+            (input_dir, score_path, pr_path), future = parse_futures.popleft()
+            _submit_parse()
+            try:
+                parsed = future.result()
+                compute_scores(
+                    input_dir, score_path, tag, max_num_msas, parsed=parsed,
+                    incremental=incremental, names=names, **score_kwargs
+                )
+                pair_rows(input_dir, score_path, pr_path, tag, parsed=parsed)
+            except Exception as e:
+                print(f'{input_dir}: {e!r}')
+                err_dirs.append(input_dir)
+            progress.update()
+        progress.close()
+
+        for input_dir, future in pair_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f'{input_dir}: {e!r}')
+                err_dirs.append(input_dir)
+
+    return err_dirs
+
+
 if __name__ == '__main__':
-    # python colattn_pair.py ./dataset/ 4 512 
+    # python colattn_pair.py ./dataset/ 4 512 [num_workers] [species_source]
     import sys
     import logging
+    from tqdm import tqdm
     logging.basicConfig(level=logging.INFO)
     
     # use column attention for pairing
@@ -80,20 +480,32 @@ if __name__ == '__main__':
     device_id = sys.argv[2]
     
     # max_msa for each batch: default 512
-    max_per_msa = 512
+    max_per_msa = 512 if len(sys.argv) <= 3 else int(sys.argv[3])
+
+    # parsing/pairing workers: default 0, i.e. process targets one by one
+    num_workers = 0 if len(sys.argv) <= 4 else int(sys.argv[4])
+
+    # header convention: default uniref (uniref90.a3m), or uniprot (uniprot.a3m)
+    species_source = 'uniref' if len(sys.argv) <= 5 else sys.argv[5]
+    names = ['uniref90.a3m'] if species_source == 'uniref' else ['uniprot.a3m']
     total_dir_list = os.listdir(input_root)
 
     os.environ['CUDA_VISIBLE_DEVICES'] = str(device_id)
+    if num_workers > 0:
+        err_dirs = run_parallel(
+            input_root, tag, max_per_msa, num_workers, names=names,
+            species_source=species_source,
+        )
+        if err_dirs:
+            print(f'Failed targets: {err_dirs}')
+        sys.exit()
+
     err_dirs = []
     for name in tqdm(total_dir_list):
         input_dir = os.path.join(input_root, name)
         
-        # calculate and save the column attention score
-        score_path = os.path.join(input_dir, f'{tag}_scores_{max_per_msa}.json')
-        if not os.path.exists(score_path):
-            compute_scores(input_dir, score_path, tag, int(max_per_msa))
-        
-        # 
-        pr_path = os.path.join(input_dir, f'{tag}_pr_{max_per_msa}.json')
-        if not os.path.exists(pr_path):
-            pair_rows(input_dir, score_path, pr_path, tag)
+        # calculate and save the column attention score, then pair the rows
+        run_target(
+            input_dir, tag, int(max_per_msa), names=names,
+            species_source=species_source,
+        )
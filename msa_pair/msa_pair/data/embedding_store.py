@@ -0,0 +1,82 @@
+import os
+import hashlib
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+def hash_sequence(sequence: str, layer: int, precision: str = 'fp32') -> bytes:
+    """Key of the embedding of a sequence at a layer. Embeddings of other
+    precisions do not share keys with the fp32 ones.
+    """
+    if precision != 'fp32':
+        sequence = f'{precision}:{sequence}'
+    return hashlib.sha1(f'{layer}:{sequence}'.encode()).digest()
+
+
+class EmbeddingStore:
+    """Embeddings keyed by sequence hash: a memory-mapped float16 matrix,
+    path.emb, and the hash of each of its rows, path.index.npy (uint8, one
+    20-byte sha1 digest per row). The matrix doubles its capacity when full;
+    call flush to persist new entries.
+    """
+    def __init__(self, path: str, dim: int, capacity: int = 1 << 14):
+        self.data_path = path + '.emb'
+        self.index_path = path + '.index.npy'
+        self.dim = dim
+        hashes = []
+        if os.path.exists(self.index_path):
+            hashes = [h.tobytes() for h in np.load(self.index_path)]
+        self.index = {h: i for i, h in enumerate(hashes)}
+        self.hashes = hashes
+        capacity = max(capacity, len(hashes))
+        if os.path.exists(self.data_path):
+            capacity = max(
+                capacity, os.path.getsize(self.data_path) // (2 * dim)
+            )
+        self._open(capacity)
+
+    def _open(self, capacity):
+        mode = 'r+' if os.path.exists(self.data_path) else 'w+'
+        if mode == 'r+' and os.path.getsize(self.data_path) < capacity * 2 * self.dim:
+            with open(self.data_path, 'r+b') as fh:
+                fh.truncate(capacity * 2 * self.dim)
+        self.data = np.memmap(
+            self.data_path, dtype=np.float16, mode=mode,
+            shape=(capacity, self.dim),
+        )
+
+    def get(self, keys: Sequence[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the mask of the keys that are stored and their embeddings
+        as float32
+        """
+        inds = np.array([self.index.get(k, -1) for k in keys], dtype=np.int64)
+        found = inds >= 0
+        return found, np.asarray(self.data[inds[found]], dtype=np.float32)
+
+    def put(self, keys: Sequence[bytes], embeddings: np.ndarray):
+        new = [
+            (k, emb) for k, emb in zip(keys, embeddings) if k not in self.index
+        ]
+        if not new:
+            return
+        size = len(self.hashes)
+        if size + len(new) > len(self.data):
+            self.data.flush()
+            capacity = len(self.data)
+            while size + len(new) > capacity:
+                capacity *= 2
+            del self.data
+            self._open(capacity)
+        for i, (k, _) in enumerate(new, start=size):
+            self.index[k] = i
+            self.hashes.append(k)
+        self.data[size:size + len(new)] = np.stack([emb for _, emb in new])
+
+    def flush(self):
+        self.data.flush()
+        index = np.frombuffer(b''.join(self.hashes), dtype=np.uint8)
+        np.save(self.index_path, index.reshape(len(self.hashes), 20))
+
+    def __len__(self):
+        return len(self.hashes)
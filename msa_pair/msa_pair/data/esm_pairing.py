@@ -39,7 +39,7 @@ def create_paired_rows_dict(
         scores_ = {}
         for chain_id, df in dfs.items():
             chain_scores_ = []
-            rows = df.msa_row.values
+            rows = df.msa_row
             for r in rows:
                 desc = msas_dict[chain_id].descriptions[r].split()[0]
                 if desc in sequences_scores[chain_id]:
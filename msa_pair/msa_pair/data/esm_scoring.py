@@ -1,19 +1,100 @@
 from asyncio import FastChildWatcher
 from importlib.machinery import all_suffixes
+import os
+import copy
 import string
+import weakref
+import itertools
+import contextlib
 from tkinter.tix import Tree
-from typing import List, Tuple, Mapping
+from typing import Iterator, List, Tuple, Mapping, Optional
 
 from tqdm import tqdm
 import torch
-import pandas as pd
+import numpy as np
 from alphafold.data import parsers
 import torch.nn.functional as F
 
 from msa_pair.data.msa_processing import MsaBlock
+from msa_pair.data.species_processing import SpeciesRows
+from msa_pair.data import score_cache as score_cache_lib
+from msa_pair.data import embedding_store as embedding_store_lib
+
+# fraction of the free memory given to the attention chunks of a forward pass
+_ATTENTION_MEMORY_FRACTION = 0.25
+# activations kept per token, in units of embed_dim (qkv, ffn and residuals)
+_ACTIVATION_FACTOR = 12
+
+
+def _cpu_cache_bytes():
+    """Size of the last level CPU cache, 32MB if it is unknown"""
+    try:
+        cache_bytes = os.sysconf('SC_LEVEL3_CACHE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        cache_bytes = 0
+    return cache_bytes if cache_bytes > 0 else 32 << 20
+
+
+def _cpu_free_bytes():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+# int8 copies of the models, quantized once per process
+_int8_models = weakref.WeakKeyDictionary()
+
+
+def _quantize_int8(msa_transformer):
+    """Dynamic int8 quantization of the linear layers of a CPU copy of the
+    model. The model itself is left as is.
+    """
+    if msa_transformer not in _int8_models:
+        _int8_models[msa_transformer] = torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(msa_transformer).cpu(), {torch.nn.Linear},
+            dtype=torch.qint8, inplace=True,
+        )
+    return _int8_models[msa_transformer]
+
+
+def _cat_outputs(outputs):
+    """Concatenate the outputs of forward passes over parts of a batch"""
+    merged = {}
+    for key, value in outputs[0].items():
+        if isinstance(value, dict):
+            merged[key] = {
+                k: torch.cat([output[key][k] for output in outputs])
+                for k in value
+            }
+        else:
+            merged[key] = torch.cat([output[key] for output in outputs])
+    return merged
+
 
 class EsmScoring:
-    def __init__(self, msa_transformer, msa_batch_converter, tag, inter_tag=False):
+    """
+    Args:
+        precision: 'fp32', 'bf16' (autocast the forward to bfloat16) or
+            'int8' (dynamic int8 quantization of the linear layers of a copy
+            of the model, shared by the scorers of the process, CPU only)
+        num_layers: ColAttn scores only use the first num_layers layers,
+            all layers if None
+        embedding_store: EmbeddingStore of the Cosim row embeddings. Stored
+            rows are not embedded again; the other rows are embedded in an
+            MSA of the query and these rows only. Row embeddings depend on
+            their MSA, so stored embeddings come from the first MSA a
+            sequence was embedded in, and scores with a warm store only
+            approximate the scores without it. The query row is stored per
+            MSA: it is embedded again for every MSA not seen before.
+    """
+    def __init__(self, msa_transformer, msa_batch_converter, tag, inter_tag=False,
+                 precision='fp32', num_layers=None, embedding_store=None):
+        if precision == 'int8':
+            msa_transformer = _quantize_int8(msa_transformer)
+        elif precision not in ('fp32', 'bf16'):
+            raise ValueError(f"No such precision {precision} !")
+        self.precision = precision
         self.msa_transformer = msa_transformer.eval()
         self.msa_batch_converter = msa_batch_converter
         deletekeys = dict.fromkeys(string.ascii_lowercase)
@@ -22,12 +103,99 @@ class EsmScoring:
         self.translation = str.maketrans(deletekeys)
         self.inter_tag = inter_tag
         self.is_cpu = False
+        self.device = None
         self.tag = tag
+        self.num_layers = num_layers
+        self.embedding_store = embedding_store
+        # scores of other precisions or depths must not share cache entries
+        self.cache_tag = tag
+        if precision != 'fp32':
+            self.cache_tag += f'-{precision}'
+        if num_layers is not None and tag == 'col':
+            self.cache_tag += f'-L{num_layers}'
 
     def set_device(self, is_cpu):
         self.is_cpu = is_cpu
         return self.is_cpu
 
+    def _autocast(self, is_cpu):
+        if self.precision == 'bf16':
+            return torch.autocast(
+                'cpu' if is_cpu else 'cuda', dtype=torch.bfloat16
+            )
+        return contextlib.nullcontext()
+
+    def _get_device(self, is_cpu):
+        """Device of the model, which is only moved when the device changes
+        """
+        if is_cpu or self.precision == 'int8' or not torch.cuda.is_available():
+            device = torch.device('cpu')
+        else:
+            device = torch.device('cuda')
+        if self.device != device:
+            self.msa_transformer = self.msa_transformer.to(device)
+            self.device = device
+        return device
+
+    def _memory_budget(self, device):
+        """Bytes available to the attention chunks of one forward pass. On CPU
+        the chunks are also kept to about the size of the last level cache.
+        """
+        if device.type == 'cuda':
+            free_bytes, _ = torch.cuda.mem_get_info(device)
+            return int(free_bytes * _ATTENTION_MEMORY_FRACTION)
+        return int(min(
+            _cpu_free_bytes() * _ATTENTION_MEMORY_FRACTION, _cpu_cache_bytes()
+        ))
+
+    def _plan_max_tokens(self, msa_batch_tokens, budget):
+        """max_tokens_per_msa such that one chunk of column attention weights,
+        heads x B x max_tokens_per_msa x R, fits in budget bytes. Column
+        attention chunks at least hold one full column (R tokens).
+        """
+        batch_size, num_rows, num_cols = msa_batch_tokens.size()
+        elem_size = 2 if self.precision == 'bf16' else 4
+        num_heads = self.msa_transformer.args.attention_heads
+        max_tokens = budget // (num_heads * batch_size * num_rows * elem_size)
+        return int(min(max(num_rows, max_tokens), num_rows * num_cols))
+
+    def _forward(self, msa_batch_tokens, is_cpu, **kwargs):
+        """Run the model on one device. Attention is chunked to fit the free
+        memory, and a batch whose activations do not fit is split along the
+        batch axis. Out-of-memory errors shrink the chunks, then split the
+        batch, instead of rerunning on another device.
+        """
+        device = self._get_device(is_cpu)
+        msa_batch_tokens = msa_batch_tokens.to(device)
+        batch_size, num_rows, num_cols = msa_batch_tokens.size()
+        budget = self._memory_budget(device)
+        if device.type == 'cuda':
+            activation_bytes = (
+                msa_batch_tokens.numel() * self.msa_transformer.args.embed_dim
+                * _ACTIVATION_FACTOR * (2 if self.precision == 'bf16' else 4)
+            )
+        else:
+            activation_bytes = 0
+        max_tokens = self._plan_max_tokens(msa_batch_tokens, budget)
+        while True:
+            if batch_size > 1 and activation_bytes > 2 * budget:
+                return _cat_outputs([
+                    self._forward(tokens, is_cpu, **kwargs)
+                    for tokens in msa_batch_tokens.split((batch_size + 1) // 2)
+                ])
+            self.msa_transformer.max_tokens_per_msa_(max_tokens)
+            try:
+                with torch.inference_mode(), self._autocast(device.type == 'cpu'):
+                    return self.msa_transformer(msa_batch_tokens, **kwargs)
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                if max_tokens > num_rows:
+                    max_tokens = max(num_rows, max_tokens // 2)
+                elif batch_size > 1:
+                    activation_bytes = float('inf')
+                else:
+                    raise
+
 
     def _read_msa(
         self,
@@ -46,28 +214,76 @@ class EsmScoring:
         ]
         return [ (desc, remove_insertions(seq)) for desc, seq in input_msa ]
 
+    def _embed_rows(
+        self,
+        input_msas: List[parsers.Msa],
+        max_num_msas: int,
+        is_cpu = False,
+        repr_layer = 12,
+    ) -> List[torch.Tensor]:
+        """Normalized mean embedding of every row of several MSAs, R x D each,
+        reusing and filling the embedding_store
+        """
+        msa_data = [
+            self._read_msa(input_msa, max_num_msas) for input_msa in input_msas
+        ]
+        embs = [None] * len(msa_data)
+        # rows of each MSA to embed, the query row first
+        todo = [list(range(len(data))) for data in msa_data]
+        store = self.embedding_store
+        if store is not None:
+            keys = []
+            for data in msa_data:
+                keys_ = [
+                    embedding_store_lib.hash_sequence(
+                        seq, repr_layer, self.precision
+                    ) for _, seq in data
+                ]
+                # every score of an MSA is taken against its query row, so
+                # the query embedding is only reused for the same MSA
+                keys_[0] = embedding_store_lib.hash_sequence(
+                    '\n'.join(seq for _, seq in data), repr_layer, self.precision
+                )
+                keys.append(keys_)
+            for i, keys_ in enumerate(keys):
+                found, stored = store.get(keys_)
+                embs[i] = torch.zeros(len(keys_), store.dim)
+                embs[i][torch.from_numpy(found)] = torch.from_numpy(stored)
+                todo[i] = [0] + [r for r in np.flatnonzero(~found).tolist() if r != 0]
+                if len(todo[i]) == 1 and found[0]:
+                    todo[i] = []
+
+        inds = [i for i, rows in enumerate(todo) if rows]
+        if inds:
+            msa_batch_tokens, num_rows, num_cols = self._tokenize([
+                [msa_data[i][r] for r in todo[i]] for i in inds
+            ])
+            repre = self._forward(
+                msa_batch_tokens, is_cpu, repr_layers=[repr_layer]
+            )['representations'][repr_layer]
+            with torch.inference_mode():
+                for b, (i, r, c) in enumerate(zip(inds, num_rows, num_cols)):
+                    emb = F.normalize(
+                        repre[b, :r, :c].float().mean(-2), p=2, dim=-1
+                    )
+                    if store is None:
+                        embs[i] = emb
+                        continue
+                    emb = emb.cpu()
+                    embs[i][todo[i]] = emb
+                    store.put([keys[i][r] for r in todo[i]], emb.numpy())
+        return embs
+
     def sim_score(self, input_msa: parsers.Msa, max_num_msas: int, is_cpu = False, repr_layers=[12]):
         """Compute the Cosim scores
         """
         assert max_num_msas <= 1024
-        msa_data = [ self._read_msa(input_msa, max_num_msas) ]
-        msa_batch_labels, msa_batch_strs, msa_batch_tokens = \
-            self.msa_batch_converter(msa_data)
-        if not is_cpu:
-            msa_transformer = self.msa_transformer.cuda()
-            msa_batch_tokens = msa_batch_tokens.cuda()
-        else:
-            msa_transformer = self.msa_transformer.cpu()
-            msa_batch_tokens = msa_batch_tokens.cpu()
-
-        with torch.no_grad():
-            repre = msa_transformer(
-                msa_batch_tokens, 
-                repr_layers=repr_layers
-            )['representations'][repr_layers[0]]
-            repre = repre.mean(-2)
-            target_emb = F.normalize(repre[:, :1], p=2, dim=-1)
-            msas_emb = F.normalize(repre[:,1:], p=2,dim=-1)
+        emb = self._embed_rows(
+            [input_msa], max_num_msas, is_cpu, repr_layer=repr_layers[0]
+        )[0]
+        with torch.inference_mode():
+            target_emb = emb[None, :1]
+            msas_emb = emb[None, 1:]
             # print(target_emb.size(), msas_emb.size())
             if self.inter_tag:
                 return msas_emb
@@ -76,53 +292,122 @@ class EsmScoring:
                 return target2sim
 
 
-    def score(self, input_msa: parsers.Msa, max_num_msas: int, is_cpu = False, repr_layers=[]):
-        """Compute the ColAttn scores
+    def sim_score_batch(
+        self,
+        input_msas: List[parsers.Msa],
+        max_num_msas: int,
+        is_cpu = False,
+        repr_layers=[12],
+    ) -> List[np.ndarray]:
+        """Compute the Cosim scores of several MSAs in one forward pass
         """
         assert max_num_msas <= 1024
-        msa_data = [ self._read_msa(input_msa, max_num_msas) ]
+        embs = self._embed_rows(
+            input_msas, max_num_msas, is_cpu, repr_layer=repr_layers[0]
+        )
+        with torch.inference_mode():
+            return [(emb[1:] @ emb[0]).cpu().numpy() for emb in embs]
+
+    def _batch_tokens(self, input_msas: List[parsers.Msa], max_num_msas: int):
+        """Tokenize several MSAs into one padded [B, R, C] tensor, keeping the
+        number of real rows and columns of each MSA
+        """
+        msa_data = [
+            self._read_msa(input_msa, max_num_msas) for input_msa in input_msas
+        ]
+        return self._tokenize(msa_data)
+
+    def _tokenize(self, msa_data: List[List[Tuple[str, str]]]):
         msa_batch_labels, msa_batch_strs, msa_batch_tokens = \
             self.msa_batch_converter(msa_data)
-        if not is_cpu:
-            msa_transformer = self.msa_transformer.cuda()
-            msa_batch_tokens = msa_batch_tokens.cuda()
-        else:
-            msa_transformer = self.msa_transformer.cpu()
-            msa_batch_tokens = msa_batch_tokens.cpu()
-        with torch.no_grad():
-            all_info = msa_transformer(
-                msa_batch_tokens, need_head_weights=True
-            )
-            col_attention = all_info['col_attentions']
-            B, C, R, R = col_attention.size()
-            # B, C, R
-            col_attention = col_attention[:, :, 0, :]
-            col_attention = col_attention.mean(-2).cpu().numpy()
+        num_rows = [len(_) for _ in msa_data]
+        num_cols = msa_batch_tokens[:, 0].ne(
+            self.msa_transformer.padding_idx
+        ).sum(-1).tolist()
+        return msa_batch_tokens, num_rows, num_cols
+
+    def score(self, input_msa: parsers.Msa, max_num_msas: int, is_cpu = False, repr_layers=[]):
+        """Compute the ColAttn scores
+        """
+        return self.score_batch([input_msa], max_num_msas, is_cpu=is_cpu)[0]
+
+    def score_batch(
+        self,
+        input_msas: List[parsers.Msa],
+        max_num_msas: int,
+        is_cpu = False,
+    ) -> List[np.ndarray]:
+        """Compute the ColAttn scores of several MSAs in one forward pass.
+        MSAs are padded to a common depth and length, and each score vector
+        is averaged over the real columns of its own MSA only.
+        """
+        assert max_num_msas <= 1024
+        msa_batch_tokens, num_rows, num_cols = self._batch_tokens(
+            input_msas, max_num_msas
+        )
+        # only the query row of the column attention is computed,
+        # without the lm_head
+        all_info = self._forward(
+            msa_batch_tokens, is_cpu,
+            scoring_only=True, last_layer=self.num_layers,
+        )
+        # B, C, R
+        col_attention = all_info['query_col_attentions']
+        col_attention = col_attention.float().cpu().numpy()
 
-        return col_attention[0][1:] # R - 1
+        return [
+            col_attention[b, :c].mean(0)[1:r] # R - 1
+            for b, (r, c) in enumerate(zip(num_rows, num_cols))
+        ]
 
     def score_sequences(
         self,
-        species_dict: Mapping[str, Mapping[str, pd.DataFrame]],
+        species_dict: Mapping[bytes, Mapping[str, SpeciesRows]],
         msas_dict: Mapping[str, parsers.Msa],
         take_num_seqs: int = 128,
         max_num_msas: int = 256,
         max_num_species: int = -1,
         show_progress: bool = True,
+        batch_size: int = 1,
+        stack_chains: bool = False,
+        score_cache: Optional[score_cache_lib.ScoreCache] = None,
+        msa_hashes: Optional[Mapping[str, str]] = None,
+        packing: str = 'greedy',
+        depth_normalize: bool = False,
+        stable: bool = False,
+        block_manifest: Optional[List[dict]] = None,
     ):
         """Compute the scores of sequences that are paired by species
         Args:
             take_num_seqs: max number of sequence per species
             max_num_msas: max number of sequence in an MsaBlock
             max_num_species: max number of species to be processed
+            packing: how species are grouped into MsaBlocks, see
+                _plan_msa_blocks
+            depth_normalize: multiply the scores by the depth of their block.
+                A query row attention is spread over all rows of the block,
+                so this puts the scores of blocks with fewer or more
+                neighbours on the same scale.
+            batch_size: number of MsaBlocks scored in one forward pass. Blocks
+                are padded to a common depth, which slightly changes the tied
+                row attention scaling of the shallower blocks.
+            stack_chains: score the MSAs of all chains of a block in the same
+                forward pass, padded to the longest chain
+            score_cache: reuse and store the scores of each chain in each
+                block, keyed by msa_hashes (content hash of each chain MSA)
+                and, for blocks padded in a batch, the padded depth
+            stable: score every species in its own block, with the query row
+                as the only context, in sorted species order. The scores of a
+                species then do not depend on the other species, and only
+                blocks of the same depth share a forward pass.
+            block_manifest: if given, the species and rows of every scored
+                block are appended to it
         """
-        msa_blocks = self._build_msa_blocks(
-            species_dict, msas_dict, take_num_seqs=take_num_seqs
+        assert score_cache is None or msa_hashes is not None
+        species_rows = self._iter_species_rows(
+            species_dict, take_num_seqs=take_num_seqs
         )
 
-        cur_msa_block = MsaBlock(
-            msas_dict, {chain_id: [0] for chain_id in msas_dict}
-        )
         sequences_scores = {
             chain_id: {
                 '0': {
@@ -132,86 +417,225 @@ class EsmScoring:
                 }
             } for chain_id, msa in msas_dict.items()
         }
+        if self.tag == 'sim':
+            score_fn = self.sim_score_batch
+        elif self.tag == 'col':
+            score_fn = self.score_batch
+        else:
+            raise ValueError(f"No such metrics {self.tag} !")
+
+        def _record_scores(chain_id, rows_, chain_msa, scores_, block_num):
+            assert len(scores_) + 1 == len(rows_)
+            for i, (r, s) in enumerate(zip(rows_[1:], scores_), start=1):
+                r = str(int(r))
+                assert r not in sequences_scores[chain_id]
+                if depth_normalize:
+                    s = s * len(rows_)
+                sequences_scores[chain_id][r] = {
+                    'description':
+                        str(chain_msa.descriptions[i]).split()[0],
+                    'score': float(s),
+                    'block_num': block_num,
+                }
+
+        pending_blocks = []
+        if stack_chains:
+            chain_groups = [list(msas_dict)]
+        else:
+            chain_groups = [[chain_id] for chain_id in msas_dict]
+
+        def _score_pending_blocks():
+            for chain_ids in chain_groups:
+                jobs = [
+                    (block_num, chain_id, msas[chain_id], rows[chain_id])
+                    for block_num, msas, rows in pending_blocks
+                    for chain_id in chain_ids
+                ]
+                batch_scores = [None] * len(jobs)
+                depths = [len(rows_) for _, _, _, rows_ in jobs]
+                padded = not stable and len(set(depths)) > 1
+                if score_cache is not None:
+                    # padding in depth changes the tied row attention, so
+                    # padded scores are keyed on the depth they were padded to
+                    cache_keys = [
+                        score_cache_lib.make_key(
+                            msa_hashes[chain_id], rows_, max_num_msas,
+                            self.cache_tag if not padded or depth == max(depths)
+                            else f'{self.cache_tag}-pad{max(depths)}'
+                        ) for (_, chain_id, _, rows_), depth in zip(jobs, depths)
+                    ]
+                    batch_scores = [score_cache.get(k) for k in cache_keys]
+                missed = [i for i, s in enumerate(batch_scores) if s is None]
+                if padded and missed:
+                    # rescore the whole batch, so that it is padded to the
+                    # same depth as without the cache
+                    missed = list(range(len(jobs)))
+                if stable:
+                    # no depth padding, which would change the scores
+                    missed_groups = {}
+                    for i in missed:
+                        missed_groups.setdefault(len(jobs[i][3]), []).append(i)
+                    missed_groups = list(missed_groups.values())
+                elif missed:
+                    missed_groups = [missed]
+                else:
+                    missed_groups = []
+                for missed_ in missed_groups:
+                    chain_msas = [jobs[i][2] for i in missed_]
+                    missed_scores = score_fn(
+                        chain_msas, max_num_msas, is_cpu=self.is_cpu
+                    )
+                    for i, scores_ in zip(missed_, missed_scores):
+                        batch_scores[i] = scores_
+                        if score_cache is not None:
+                            score_cache.put(cache_keys[i], scores_)
+                for (block_num, chain_id, chain_msa, rows_), scores_ in zip(
+                    jobs, batch_scores
+                ):
+                    _record_scores(
+                        chain_id, rows_, chain_msa, scores_, block_num,
+                    )
+            pending_blocks.clear()
+            if score_cache is not None:
+                score_cache.commit()
+
         def _score_cur_block():
             if not hasattr(_score_cur_block, 'block_num'):
                 _score_cur_block.block_num = 0
             _score_cur_block.block_num += 1
-            chain_msas = cur_msa_block.get_msas()
-            rows = cur_msa_block.get_rows()
-            for chain_id, chain_msa in chain_msas.items():
-                if self.tag == 'sim':
-                    try:
-                        scores_ = self.sim_score(chain_msa, max_num_msas, is_cpu = False)
-                    except:
-                        scores_ = self.sim_score(chain_msa, max_num_msas, is_cpu = True)
-                elif self.tag == 'col':
-                    try:
-                        scores_ = self.score(chain_msa, max_num_msas, is_cpu = False)
-                    except:
-                        scores_ = self.score(chain_msa, max_num_msas, is_cpu = True)
-                else:
-                    raise ValueError(f"No such metrics {self.tag} !")
-                rows_ = rows[chain_id]
-                # print(len(scores_), len(rows_))
-                assert len(scores_) + 1 == len(rows_)
-                for i, (r, s) in enumerate(zip(rows_[1:], scores_), start=1):
-                    r = str(int(r))
-                    assert r not in sequences_scores[chain_id]
-                    # if r in sequences_scores[chain_id]:
-                    #     print("orig:", sequences_scores[chain_id][r])
-                    #     print("cur: ",  {
-                    #     'description': 
-                    #         str(chain_msa.descriptions[i]).split()[0],
-                    #     'score': float(s),
-                    #     'block_num': _score_cur_block.block_num,
-                    #     })
-                    #     print(r)
-
-                    sequences_scores[chain_id][r] = {
-                        'description': 
-                            str(chain_msa.descriptions[i]).split()[0],
-                        'score': float(s),
-                        'block_num': _score_cur_block.block_num,
-                    }
-
-        all_msa_blocks = list(msa_blocks.items())
+            pending_blocks.append((
+                _score_cur_block.block_num,
+                cur_msa_block.get_msas(),
+                cur_msa_block.get_rows(),
+            ))
+            if len(pending_blocks) >= batch_size:
+                _score_pending_blocks()
+
+        if stable:
+            species_rows = sorted(species_rows, key=lambda v: v[0])
         if max_num_species > 0:
-            all_msa_blocks = all_msa_blocks[:max_num_species]
+            species_rows = itertools.islice(species_rows, max_num_species)
+        if stable:
+            # blocks of the same depth are next to each other in a batch
+            block_plan = (
+                [(spec, rows_dict)] for spec, rows_dict in sorted(
+                    species_rows,
+                    key=lambda v: (
+                        sorted((c, len(r)) for c, r in v[1].items()), v[0]
+                    ),
+                )
+            )
+        else:
+            block_plan = self._plan_msa_blocks(
+                species_rows, list(msas_dict), max_num_msas, packing=packing
+            )
         if show_progress:
-            progress = tqdm(all_msa_blocks)
+            progress = tqdm(block_plan)
         else:
-            progress = all_msa_blocks
-
-        for spec, msa_block in progress:
-            cur_lengths = cur_msa_block.get_lengths()
-            next_lengths = {
-                chain_id:
-                this_length if chain_id not in cur_lengths else
-                this_length + cur_lengths[chain_id]
-                for chain_id, this_length in msa_block.get_lengths().items()
-            }
-            # print(next_lengths, max_num_msas)
-            if max(next_lengths.values()) >= max_num_msas:
-                _score_cur_block()
-                cur_msa_block = MsaBlock(
-                    msas_dict, {chain_id: [0] for chain_id in msas_dict}
-                )
-            cur_msa_block += msa_block
+            progress = block_plan
 
-        if max(cur_msa_block.get_lengths().values()) > 1:
+        # every block is scored as soon as it is planned
+        for block_species in progress:
+            block_specs = [spec for spec, _ in block_species]
+            cur_msa_block = MsaBlock(
+                msas_dict, {chain_id: [0] for chain_id in msas_dict}
+            )
+            for _, rows_dict in block_species:
+                cur_msa_block += MsaBlock(
+                    {chain_id: msas_dict[chain_id] for chain_id in rows_dict},
+                    rows_dict,
+                )
             _score_cur_block()
+            if block_manifest is not None:
+                block_manifest.append({
+                    'block_num': _score_cur_block.block_num,
+                    'species': [spec.decode() for spec in block_specs],
+                    'rows': {
+                        chain_id: [int(r) for r in rows_]
+                        for chain_id, rows_ in cur_msa_block.get_rows().items()
+                    },
+                })
+
+        if pending_blocks:
+            _score_pending_blocks()
 
         return sequences_scores
 
-    def _build_msa_blocks(
-        self, species_dict, msas_dict, gap_cutoff=0.4, take_num_seqs=128,
-    ):
-        def _filter_rows(df):
-            df = df.sort_values('msa_similarity', axis=0, ascending=False)
-            rows = df.msa_row[df.gap <= gap_cutoff].iloc[:take_num_seqs].values
-            return rows.astype(int)
+    def _plan_msa_blocks(
+        self, species_rows, chain_ids, max_num_msas, packing='greedy',
+    ) -> Iterator[List[Tuple[bytes, Mapping[str, np.ndarray]]]]:
+        """Group species into MsaBlocks that, with the query row, hold fewer
+        than max_num_msas rows of each chain. A species that is too large on
+        its own gets a block of its own.
+        Args:
+            species_rows: iterable of (species, rows of each chain), e.g.
+                _iter_species_rows
+            packing: 'greedy' fills blocks in species order and starts a new
+                block when the next species does not fit; blocks are yielded
+                as soon as they are full. 'ffd' is first-fit-decreasing:
+                species are placed from the largest to the smallest in the
+                first block they fit in, which gives fewer and fuller blocks,
+                but needs the sizes of all species first.
+        Yields:
+            the (species, rows of each chain) of each block
+        """
+        def _size(rows_dict):
+            return np.array(
+                [len(rows_dict.get(chain_id, [])) for chain_id in chain_ids],
+                dtype=np.int64,
+            )
+
+        # block capacity per chain, the query row excluded
+        capacity = max_num_msas - 2
+
+        if packing == 'greedy':
+            cur_block, cur_load = [], np.zeros(len(chain_ids), dtype=np.int64)
+            for spec, rows_dict in species_rows:
+                size = _size(rows_dict)
+                if cur_block and (cur_load + size).max() > capacity:
+                    yield cur_block
+                    cur_block, cur_load = [], np.zeros_like(cur_load)
+                cur_block.append((spec, rows_dict))
+                cur_load += size
+            if cur_block:
+                yield cur_block
+            return
+        if packing != 'ffd':
+            raise ValueError(f"No such packing {packing} !")
+
+        species_rows = list(species_rows)
+        sizes = np.array(
+            [_size(rows_dict) for _, rows_dict in species_rows], dtype=np.int64
+        ).reshape(len(species_rows), len(chain_ids))
+        order = np.argsort(-sizes.max(-1), kind='stable')
+        loads = np.zeros((len(species_rows), len(chain_ids)), dtype=np.int64)
+        block_items = []
+        for i in order:
+            fits = np.flatnonzero(
+                (loads[:len(block_items)] + sizes[i]).max(-1) <= capacity
+            )
+            if len(fits):
+                b = fits[0]
+            else:
+                b = len(block_items)
+                block_items.append([])
+            loads[b] += sizes[i]
+            block_items[b].append(i)
+        # keep the species order within and across blocks
+        for items in sorted(sorted(items) for items in block_items):
+            yield [species_rows[i] for i in items]
+
+    def _iter_species_rows(
+        self, species_dict, gap_cutoff=0.4, take_num_seqs=128,
+    ) -> Iterator[Tuple[bytes, Mapping[str, np.ndarray]]]:
+        """Yield the species with rows in at least two chains, and the rows of
+        each chain kept for scoring
+        """
+        def _filter_rows(species_rows):
+            # rows are already sorted by decreasing similarity
+            rows = species_rows.msa_row[species_rows.gap <= gap_cutoff]
+            return rows[:take_num_seqs].astype(int)
 
-        msa_blocks = {}
         for spec, dfs in species_dict.items():
             rows_dict = {}
             if spec == b'':
@@ -226,99 +650,115 @@ class EsmScoring:
             if len(rows_dict) < 2:
                 continue
 
-            msa_blocks[spec] = MsaBlock(msas_dict, rows_dict)
+            yield spec, rows_dict
 
-        return msa_blocks
+    def _build_msa_blocks(
+        self, species_dict, msas_dict, gap_cutoff=0.4, take_num_seqs=128,
+    ):
+        return {
+            spec: MsaBlock(
+                {chain_id: msas_dict[chain_id] for chain_id in rows_dict},
+                rows_dict,
+            ) for spec, rows_dict in self._iter_species_rows(
+                species_dict, gap_cutoff=gap_cutoff, take_num_seqs=take_num_seqs
+            )
+        }
 
     def score_inter_sequences(
         self,
-        species_dict: Mapping[str, Mapping[str, pd.DataFrame]],
+        species_dict: Mapping[bytes, Mapping[str, SpeciesRows]],
         msas_dict: Mapping[str, parsers.Msa],
         take_num_seqs: int = 128,
         max_num_msas: int = 256,
         max_num_species: int = -1,
         show_progress: bool = True,
     ):
-        """Compute the scores of sequences that are paired by species
+        """Compute the similarities between the sequences of chain A and B
+        that are paired by species
         Args:
             take_num_seqs: max number of sequence per species
             max_num_msas: max number of sequence in an MsaBlock
             max_num_species: max number of species to be processed
+        Returns:
+            ragged arrays over species: the rows of species[i] are
+            rowsA[rowsA_offsets[i]:rowsA_offsets[i + 1]] (same for rowsB), and
+            their len(rowsA) x len(rowsB) similarities, flattened row-major,
+            are sims[sims_offsets[i]:sims_offsets[i + 1]]
         """
-        msa_blocks = self._build_msa_blocks(
-            species_dict, msas_dict, take_num_seqs=take_num_seqs
+        species_rows = self._iter_species_rows(
+            species_dict, take_num_seqs=take_num_seqs
         )
-
-        cur_msa_block = MsaBlock(
-            msas_dict, {chain_id: [0] for chain_id in msas_dict}
+        if max_num_species > 0:
+            species_rows = itertools.islice(species_rows, max_num_species)
+        block_plan = self._plan_msa_blocks(
+            species_rows, list(msas_dict), max_num_msas
         )
-        cur_spec_len = []
-        sequences_scores = {}
-        def _score_cur_block():
-            if not hasattr(_score_cur_block, 'block_num'):
-                _score_cur_block.block_num = 0
-            _score_cur_block.block_num += 1
-            chain_msas = cur_msa_block.get_msas()
-            rows = cur_msa_block.get_rows()
-            chain2emb = {}
-            for chain_id, chain_msa in chain_msas.items():
-                try:
-                    seqEmb = self.sim_score(chain_msa, max_num_msas)
-                except:
-                    seqEmb = self.sim_score(chain_msa, max_num_msas, True)
-                chain2emb[chain_id] = seqEmb
-
-            cur_sa = 0
-            cur_sb = 0
-
-            for each in cur_spec_len:
-                spec, chainLen = each
-                Alen, Blen = chainLen['A'], chainLen['B'] 
-                seqA_emb = chain2emb['A'][:, cur_sa:(cur_sa+Alen)]
-                seqB_emb = chain2emb['B'][:, cur_sb:(cur_sb+Blen)]
-
-                inter_sims = torch.bmm(seqA_emb, seqB_emb.transpose(-1,-2)).squeeze(0).cpu().numpy()
-
-                # print(inter_sims.shape)
-                rowsA = rows['A'][(cur_sa + 1) : (cur_sa + Alen + 1)]
-                rowsB = rows['B'][(cur_sb + 1) : (cur_sb + Blen + 1)]
-
-                cur_sa += Alen
-                cur_sb += Blen
-
-                assert spec not in sequences_scores
-                sequences_scores[spec]={
-                    "rowsA": rowsA,
-                    "rowsB": rowsB,
-                    "sims": inter_sims
-                }
 
-        all_msa_blocks = list(msa_blocks.items())
-        if max_num_species > 0:
-            all_msa_blocks = all_msa_blocks[:max_num_species]
-        if show_progress:
-            progress = tqdm(all_msa_blocks)
-        else:
-            progress = all_msa_blocks
-
-        for spec, msa_block in progress:
-            cur_lengths = cur_msa_block.get_lengths()
-            next_lengths = {
-                chain_id:
-                this_length if chain_id not in cur_lengths else
-                this_length + cur_lengths[chain_id]
-                for chain_id, this_length in msa_block.get_lengths().items()
-            }
-            if max(next_lengths.values()) >= max_num_msas:
-                _score_cur_block()
-                cur_msa_block = MsaBlock(
-                    msas_dict, {chain_id: [0] for chain_id in msas_dict}
+        species = []
+        spec_rows = {'A': [], 'B': []}
+        sims = []
+        def _score_block(block_species):
+            block_specs = [spec for spec, _ in block_species]
+            cur_msa_block = MsaBlock(
+                msas_dict, {chain_id: [0] for chain_id in msas_dict}
+            )
+            for _, rows_dict in block_species:
+                cur_msa_block += MsaBlock(
+                    {chain_id: msas_dict[chain_id] for chain_id in rows_dict},
+                    rows_dict,
                 )
-                cur_spec_len = []
-            cur_msa_block += msa_block
-            cur_spec_len.append((spec, msa_block.get_lengths()))
-
-        if max(cur_msa_block.get_lengths().values()) > 1:
-            _score_cur_block()
+            block_rows = cur_msa_block.get_rows()
+            rows, lengths, embs = {}, {}, {}
+            for chain_id in ('A', 'B'):
+                rows_ = [
+                    np.sort(rows_dict[chain_id]) for _, rows_dict in block_species
+                ]
+                spec_rows[chain_id] += rows_
+                rows[chain_id] = np.concatenate(rows_)
+                lengths[chain_id] = np.array([len(_) for _ in rows_])
+                # R - 1 x D, the query row excluded
+                emb = self.sim_score(
+                    cur_msa_block.get_msas()[chain_id], max_num_msas,
+                    is_cpu=self.is_cpu,
+                )[0]
+                # species after species
+                pos = np.searchsorted(block_rows[chain_id], rows[chain_id]) - 1
+                embs[chain_id] = emb[torch.from_numpy(pos).to(emb.device)]
+
+            # one product per block, then its species blocks on the diagonal
+            with torch.inference_mode():
+                block_sims = embs['A'] @ embs['B'].T
+                len_a, len_b = lengths['A'], lengths['B']
+                num_sims = len_a * len_b
+                spec_inds = np.repeat(np.arange(len(block_specs)), num_sims)
+                k = np.arange(num_sims.sum()) - \
+                    np.repeat(np.cumsum(num_sims) - num_sims, num_sims)
+                i = (np.cumsum(len_a) - len_a)[spec_inds] + k // len_b[spec_inds]
+                j = (np.cumsum(len_b) - len_b)[spec_inds] + k % len_b[spec_inds]
+                sims.append(block_sims[
+                    torch.from_numpy(i).to(block_sims.device),
+                    torch.from_numpy(j).to(block_sims.device),
+                ].float().cpu().numpy())
+            species.extend(block_specs)
 
-        return sequences_scores
\ No newline at end of file
+        if show_progress:
+            progress = tqdm(block_plan)
+        else:
+            progress = block_plan
+        for block_species in progress:
+            _score_block(block_species)
+
+        def _offsets(lengths):
+            return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        len_a = np.array([len(_) for _ in spec_rows['A']], dtype=np.int64)
+        len_b = np.array([len(_) for _ in spec_rows['B']], dtype=np.int64)
+        return {
+            'species': species,
+            'rowsA': np.concatenate(spec_rows['A'] or [np.zeros(0, dtype=int)]),
+            'rowsA_offsets': _offsets(len_a),
+            'rowsB': np.concatenate(spec_rows['B'] or [np.zeros(0, dtype=int)]),
+            'rowsB_offsets': _offsets(len_b),
+            'sims': np.concatenate(sims or [np.zeros(0, dtype=np.float32)]),
+            'sims_offsets': _offsets(len_a * len_b),
+        }
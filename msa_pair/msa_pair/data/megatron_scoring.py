@@ -6,11 +6,11 @@ from typing import List, Tuple, Mapping
 
 from tqdm import tqdm
 import torch
-import pandas as pd
 from alphafold.data import parsers
 import torch.nn.functional as F
 
 from msa_pair.data.msa_processing import MsaBlock
+from msa_pair.data.species_processing import SpeciesRows
 
 class EsmScoring:
     def __init__(self, msa_transformer, msa_batch_converter):
@@ -75,7 +75,7 @@ class EsmScoring:
 
     def score_sequences(
         self,
-        species_dict: Mapping[str, Mapping[str, pd.DataFrame]],
+        species_dict: Mapping[bytes, Mapping[str, SpeciesRows]],
         msas_dict: Mapping[str, parsers.Msa],
         take_num_seqs: int = 128,
         max_num_msas: int = 512,
@@ -173,10 +173,10 @@ class EsmScoring:
     def _build_msa_blocks(
         self, species_dict, msas_dict, gap_cutoff=0.4, take_num_seqs=128,
     ):
-        def _filter_rows(df):
-            df = df.sort_values('msa_similarity', axis=0, ascending=False)
-            rows = df.msa_row[df.gap <= gap_cutoff].iloc[:take_num_seqs].values
-            return rows.astype(int)
+        def _filter_rows(species_rows):
+            # rows are already sorted by decreasing similarity
+            rows = species_rows.msa_row[species_rows.gap <= gap_cutoff]
+            return rows[:take_num_seqs].astype(int)
 
         msa_blocks = {}
         for spec, dfs in species_dict.items():
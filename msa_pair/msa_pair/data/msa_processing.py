@@ -14,44 +14,35 @@ def _build_msa(input_msa, rows):
     )
 
 class _MsaSubset:
+    """Rows of an MSA, kept as indices into the parent MSA. Sequences are only
+    copied out in build_msa.
+    """
     def __init__(self, main_msa: parsers.Msa, rows: Sequence[int]):
-        self.msa_subset = {}
-        for r in sorted(set(rows)):
-            self.msa_subset[r] = {
-                key: getattr(main_msa, key)[r] for key in [
-                    'sequences', 'descriptions', 'deletion_matrix'
-                ]
-            }
+        self.main_msa = main_msa
+        self.row_set = set(int(r) for r in rows)
 
+    def copy(self):
+        return _MsaSubset(self.main_msa, self.row_set)
 
     def __add__(self, next_subset):
-        this_subset = copy.deepcopy(self)
-        for r, v in next_subset.msa_subset.items():
-            if r in this_subset.msa_subset:
-                assert v['sequences'] == this_subset.msa_subset[r]['sequences']
-            else:
-                this_subset.msa_subset[r] = v
-
+        this_subset = self.copy()
+        this_subset += next_subset
         return this_subset
 
+    def __iadd__(self, next_subset):
+        assert next_subset.main_msa is self.main_msa
+        self.row_set.update(next_subset.row_set)
+        return self
+
     def build_msa(self):
-        rows_sorted = self.rows
-        return parsers.Msa(
-            sequences=[self.msa_subset[r]['sequences'] for r in rows_sorted],
-            deletion_matrix=[
-                self.msa_subset[r]['deletion_matrix'] for r in rows_sorted
-            ],
-            descriptions=[
-                self.msa_subset[r]['descriptions'] for r in rows_sorted
-            ],
-        )
+        return _build_msa(self.main_msa, self.rows)
 
     @property
     def rows(self):
-        return sorted(self.msa_subset)
+        return sorted(self.row_set)
 
     def __len__(self):
-        return len(self.msa_subset)
+        return len(self.row_set)
 
 class MsaBlock:
     def __init__(
@@ -66,14 +57,22 @@ class MsaBlock:
         }
 
     def __add__(self, next_block):
-        this_block = copy.deepcopy(self)
+        this_block = copy.copy(self)
+        this_block.msa_subsets = {
+            chain_id: msa_subset.copy()
+            for chain_id, msa_subset in self.msa_subsets.items()
+        }
+        this_block += next_block
+        return this_block
+
+    def __iadd__(self, next_block):
         for chain_id, msa_subset in next_block.msa_subsets.items():
             if chain_id in self.msa_subsets:
-                this_block.msa_subsets[chain_id] += msa_subset
+                self.msa_subsets[chain_id] += msa_subset
             else:
-                this_block.msa_subsets[chain_id] = msa_subset
+                self.msa_subsets[chain_id] = msa_subset.copy()
 
-        return this_block
+        return self
 
     def get_msas(self):
         return {
@@ -2,16 +2,91 @@ from contextlib import suppress
 import os
 import json
 from typing import List, Mapping
-from collections import defaultdict
 import numpy as np
 np.set_printoptions(threshold=np.inf)
 np.set_printoptions(suppress = True)
 
 from alphafold.data import parsers, msa_pairing, feature_processing
 from alphafold.common import residue_constants
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import min_weight_full_bipartite_matching
-from operator import itemgetter
+
+def save_scores(dst_path, sequences_scores):
+    """Save the scores of score_sequences. A .npz path gets one row, score,
+    block_num and description array per chain, any other path indented JSON.
+    """
+    if not dst_path.endswith('.npz'):
+        with open(dst_path, 'wt') as fh:
+            json.dump(sequences_scores, fh, indent=4, sort_keys=True)
+        return
+    arrays = {}
+    for chain_id, chain_scores in sequences_scores.items():
+        rows = sorted(chain_scores, key=int)
+        arrays[f'{chain_id}/row'] = np.array(rows, dtype=np.int32)
+        arrays[f'{chain_id}/score'] = np.array(
+            [chain_scores[r]['score'] for r in rows], dtype=np.float32
+        )
+        arrays[f'{chain_id}/block_num'] = np.array(
+            [chain_scores[r]['block_num'] for r in rows], dtype=np.int32
+        )
+        arrays[f'{chain_id}/description'] = np.array(
+            [chain_scores[r]['description'].encode() for r in rows],
+            dtype=np.bytes_,
+        )
+    np.savez(dst_path, **arrays)
+
+
+def load_scores(src_path):
+    """Load the scores saved by save_scores, as a dict by chain and row"""
+    if not src_path.endswith('.npz'):
+        with open(src_path) as fh:
+            return json.load(fh)
+    with np.load(src_path) as data:
+        chain_ids = sorted({key.split('/')[0] for key in data.files})
+        return {
+            chain_id: {
+                str(r): {
+                    'description': description.decode(),
+                    'score': float(score),
+                    'block_num': int(block_num),
+                } for r, score, block_num, description in zip(
+                    data[f'{chain_id}/row'].tolist(),
+                    data[f'{chain_id}/score'].tolist(),
+                    data[f'{chain_id}/block_num'].tolist(),
+                    data[f'{chain_id}/description'].tolist(),
+                )
+            } for chain_id in chain_ids
+        }
+
+
+def save_paired_rows(dst_path, paired_rows_dict):
+    """Save paired rows. A .npz path gets a num_pairs x num_chains int32
+    matrix with the chain_ids of its columns, any other path JSON.
+    """
+    if not dst_path.endswith('.npz'):
+        with open(dst_path, 'wt') as fh:
+            json.dump(paired_rows_dict, fh, indent=4)
+        return
+    chain_ids = list(paired_rows_dict)
+    np.savez(
+        dst_path,
+        chain_ids=np.array(chain_ids, dtype=np.str_),
+        paired_rows=np.stack([
+            np.asarray(paired_rows_dict[chain_id], dtype=np.int32)
+            for chain_id in chain_ids
+        ], axis=-1),
+    )
+
+
+def load_paired_rows(src_path):
+    """Load the paired rows saved by save_paired_rows, as a dict by chain"""
+    if not src_path.endswith('.npz'):
+        with open(src_path) as fh:
+            return json.load(fh)
+    with np.load(src_path) as data:
+        return {
+            str(chain_id): rows.tolist() for chain_id, rows in
+            zip(data['chain_ids'], data['paired_rows'].T)
+        }
+
 
 def _upgrade_sequences_scores(sequence_scores):
     processed_scores = {}
@@ -22,91 +97,84 @@ def _upgrade_sequences_scores(sequence_scores):
 
     return processed_scores
 
+def _make_row_scores(msa, chain_scores):
+    """Score of every row of msa, looked up by description, NaN if the row
+    was not scored
+    """
+    desc2score = _upgrade_sequences_scores(chain_scores)
+    return np.array([
+        desc2score.get(desc.split()[0], np.nan) for desc in msa.descriptions
+    ], dtype=np.float64)
+
 def create_paired_rows_dict(
     species_dict,
     msas_dict,
     sequences_scores,
     chain_ids: List[str] = ['A', 'B'],
 ) -> Mapping[str, List[int]]:
+    """Pair the scored rows of each species: the rows of each chain are sorted
+    by decreasing score, the top num_seqs rows of the chains are paired, with
+    num_seqs the smallest number of scored rows of a chain, and all pairs are
+    then sorted by decreasing summed score. The query rows come first.
+    """
+    specs = [spec for spec in species_dict if spec != b'']
+    num_specs = len(specs)
 
-    # upgrade sequences scores 
+    # sort the scored rows of each chain by species, then decreasing score
+    chain_rows, chain_specs, chain_scores, counts = {}, {}, {}, {}
     for chain_id in chain_ids:
-        sequences_scores[chain_id] = _upgrade_sequences_scores(
-            sequences_scores[chain_id]
+        row_scores = _make_row_scores(
+            msas_dict[chain_id], sequences_scores[chain_id]
+        )
+        rows = [
+            species_dict[spec][chain_id].msa_row
+            if chain_id in species_dict[spec] else np.zeros(0, dtype=int)
+            for spec in specs
+        ]
+        spec_inds = np.repeat(
+            np.arange(num_specs), [len(rows_) for rows_ in rows]
         )
+        rows = np.concatenate(rows).astype(np.int64) if rows else \
+            np.zeros(0, dtype=np.int64)
+        scores = row_scores[rows]
+        scored = ~np.isnan(scores)
+        rows, spec_inds, scores = rows[scored], spec_inds[scored], scores[scored]
+        # ties keep the similarity order of the species rows
+        order = np.lexsort((-scores, spec_inds))
+        chain_rows[chain_id] = rows[order]
+        chain_specs[chain_id] = spec_inds[order]
+        chain_scores[chain_id] = scores[order]
+        counts[chain_id] = np.bincount(spec_inds, minlength=num_specs)
 
-    paired_rows_dict = {chain_id: [0] for chain_id in chain_ids}
-    # pair_scores = [ np.full((1, len(chain_ids)), 1e6) ]
-    pair_scores = [ np.full((1, len(chain_ids)), -1e6) ] # reverse
-    
+    # species with scored rows in more than one chain
+    counts_mat = np.stack([counts[chain_id] for chain_id in chain_ids], axis=-1)
+    num_seqs = np.where(counts_mat > 0, counts_mat, np.iinfo(np.int64).max).min(-1)
+    num_seqs[(counts_mat > 0).sum(-1) < 2] = 0
+    offsets = np.concatenate([[0], np.cumsum(num_seqs)])
+
+    # pair the top num_seqs rows of the chains, after the query rows
+    num_pairs = 1 + int(offsets[-1])
+    paired_rows = np.full((num_pairs, len(chain_ids)), -1, dtype=np.int64)
+    pair_scores = np.zeros((num_pairs, len(chain_ids)))
+    paired_rows[0] = 0
+    pair_scores[0] = -1e6 # reverse
+    for i, chain_id in enumerate(chain_ids):
+        spec_inds = chain_specs[chain_id]
+        starts = np.concatenate([[0], np.cumsum(counts[chain_id])])[spec_inds]
+        ranks = np.arange(len(spec_inds)) - starts
+        kept = ranks < num_seqs[spec_inds]
+        dst = 1 + offsets[spec_inds[kept]] + ranks[kept]
+        paired_rows[dst, i] = chain_rows[chain_id][kept]
+        pair_scores[dst, i] = chain_scores[chain_id][kept]
 
-    spec2ind2score = defaultdict(list)
-    for spec, dfs in species_dict.items():
-        if spec == b'':
-            continue
-        # spec = b'CERCE'
-        # dfs = species_dict[spec]
-
-        # find and sort scores
-        scores_ = {}
-        for chain_id, df in dfs.items():
-            chain_scores_ = []
-            rows = df.msa_row.values
-            # print(rows)
-            for r in rows:
-                desc = msas_dict[chain_id].descriptions[r].split()[0]
-                if desc in sequences_scores[chain_id]:
-                    s = sequences_scores[chain_id][desc]
-                    chain_scores_.append((int(r), s))
-                # if int(r) == 90:
-                #     print(dfs['A'])
-                #     print(dfs['B'])
-                #     print(desc)
-                #     print(chain_scores_)
-                    # exit()
-            # print(chain_scores_)
-            if len(chain_scores_) >= 1:
-                scores_[chain_id] = sorted(
-                    chain_scores_, key=lambda v: v[-1], reverse=True,
-                )
-        # print(scores_)
-        
-        # exit()
-
-        # match rows within the species
-        if len(scores_) > 1:
-            num_seqs = min(len(v) for v in scores_.values())
-            pair_scores_ = []
-            for chain_id in chain_ids:
-                tmp = {}
-                if chain_id in scores_:
-                    chain_rows_ = [
-                        _[0] for _ in scores_[chain_id][:num_seqs]
-                    ]
-                    chain_scores_ = [
-                        _[-1] for _ in scores_[chain_id][:num_seqs]
-                    ]
-                else:
-                    chain_rows_ = [-1] * num_seqs
-                    chain_scores_ = [0.] * num_seqs
-                tmp[chain_id] = scores_[chain_id][:num_seqs]
-                spec2ind2score[spec].append(tmp)
-                paired_rows_dict[chain_id] += chain_rows_
-                pair_scores_ += [np.array(chain_scores_)[:,None]]
-            pair_scores.append(np.concatenate(pair_scores_, axis=-1))
     # sort rows by their pair scores
-    pair_scores = np.concatenate(pair_scores, axis=0)
     # inds_sorted = np.argsort(np.sum(pair_scores, axis=-1))[::-1]
     inds_sorted = np.argsort(np.sum(pair_scores, axis=-1)) # reverse
-    # print(np.sum(pair_scores, axis=-1)[inds_sorted])
-    # print(inds_sorted[:10])
-    # # print(np.sum(pair_scores, axis=-1)[inds_sorted][:10])
-    
-    paired_rows_dict  = {
-        chain_id: [rows[i] for i in inds_sorted] for chain_id, rows in 
-        paired_rows_dict.items()
+    paired_rows = paired_rows[inds_sorted]
+    paired_rows_dict = {
+        chain_id: paired_rows[:, i].tolist()
+        for i, chain_id in enumerate(chain_ids)
     }
-    assert len(pair_scores) == len(paired_rows_dict[chain_ids[0]])
     # check the first row is always zero (that is, the first sequence is 
     # always the query sequence)
     assert all(rows[0] == 0 for rows in paired_rows_dict.values())
@@ -115,60 +183,130 @@ def create_paired_rows_dict(
 
 
 
+def _greedy_matching(sims, valid=None):
+    """Greedy matching of a batch of similarity matrices [S, n, m]: pairs are
+    taken by decreasing similarity, ties in row-major order, skipping pairs
+    whose row or column is already taken. Computed in rounds, each taking
+    every remaining pair that is the best of both its row and its column.
+    Args:
+        valid: mask of the real pairs of padded matrices
+    Returns:
+        mask of the matched pairs and the rank of every pair in the order
+        they are taken
+    """
+    num_specs, lenx, leny = sims.shape
+    order = np.argsort(-sims.reshape(num_specs, -1), axis=-1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(
+        ranks, order, np.arange(lenx * leny)[None].repeat(num_specs, 0), axis=-1
+    )
+    ranks = ranks.reshape(sims.shape)
+    active = np.ones(sims.shape, dtype=bool) if valid is None else valid.copy()
+    matched = np.zeros(sims.shape, dtype=bool)
+    while active.any():
+        active_ranks = np.where(active, ranks, lenx * leny)
+        picked = active & \
+            (active_ranks == active_ranks.min(-1, keepdims=True)) & \
+            (active_ranks == active_ranks.min(-2, keepdims=True))
+        matched |= picked
+        active &= ~picked.any(-1, keepdims=True) & ~picked.any(-2, keepdims=True)
+    return matched, ranks
+
+
 def find_alignment(rowsA, rowsB, sims, tag):
-    ori_sims = sims
     lenx, leny = sims.shape
     # print(sims.shape, len(rowsA), len(rowsB))
     assert (lenx == len(rowsA)) and (leny == len(rowsB))
     num_seqs = min(len(rowsA), len(rowsB))
-    alignments = []
     if tag == 'local':
-        sims = sims.reshape(-1)
-        index = np.argsort(-sims)
-        det_x = set()
-        det_y = set()
-        for each in index:
-            row, col = int(each/leny), each % leny
-            if row in det_x or col in det_y:
-                continue
-            det_x.add(row)
-            det_y.add(col)
-            alignments.append((rowsA[row], rowsB[col], sims[each]))
-        assert len(alignments) == num_seqs
-        # print(alignments)
-        # exit()
+        matched, ranks = _greedy_matching(sims[None])
+        rows, cols = np.nonzero(matched[0])
+        # in the order the pairs were taken
+        order = np.argsort(ranks[0, rows, cols])
     elif tag =='global':
-        tmp_align = []
-        sims = csr_matrix(sims)
-        rows, cols = min_weight_full_bipartite_matching(sims, maximize = True)
-        sims = sims.toarray()
-        assert len(rows) == len(cols) == num_seqs
-        for x, y in zip(rows, cols):
-            tmp_align.append((rowsA[x], rowsB[y], sims[x][y]))
-        alignments = sorted(tmp_align, key=itemgetter(2), reverse=True)
+        from scipy.optimize import linear_sum_assignment
+
+        # dense Hungarian, rectangular sims are matched on the shorter side
+        rows, cols = linear_sum_assignment(sims, maximize=True)
+        order = np.argsort(-sims[rows, cols], kind='stable')
     else:
         raise ValueError(f"No such strategy: {tag}!")
-    
+    rows, cols = rows[order], cols[order]
+    assert len(rows) == num_seqs
+    alignments = [
+        (rowsA[x], rowsB[y], sims[x, y]) for x, y in zip(rows, cols)
+    ]
     return alignments, num_seqs
-            
 
 
+def find_alignments(species_sims, tag, max_batch_size=64):
+    """find_alignment over many species. Species whose similarity matrices
+    are small, or have a single row or column (where local and global
+    matching agree), are matched together in padded batches.
+    Args:
+        species_sims: list of (rowsA, rowsB, sims)
+    Returns:
+        list of the alignments of each species
+    """
+    def _padded_size(n):
+        return 1 if n == 1 else 1 << int(n - 1).bit_length()
+
+    alignments = [None] * len(species_sims)
+    groups = {}
+    for i, (rowsA, rowsB, sims) in enumerate(species_sims):
+        lenx, leny = sims.shape
+        if (tag == 'local' and max(lenx, leny) <= 32) or min(lenx, leny) == 1:
+            shape = (_padded_size(lenx), _padded_size(leny))
+            groups.setdefault(shape, []).append(i)
+        else:
+            alignments[i], _ = find_alignment(rowsA, rowsB, sims, tag)
+
+    for (lenx, leny), inds in groups.items():
+        for start in range(0, len(inds), max_batch_size):
+            batch = inds[start:start + max_batch_size]
+            padded = np.full((len(batch), lenx, leny), -np.inf)
+            valid = np.zeros(padded.shape, dtype=bool)
+            for b, i in enumerate(batch):
+                sims = species_sims[i][2]
+                padded[b, :sims.shape[0], :sims.shape[1]] = sims
+                valid[b, :sims.shape[0], :sims.shape[1]] = True
+            matched, ranks = _greedy_matching(padded, valid)
+            for b, i in enumerate(batch):
+                rowsA, rowsB, sims = species_sims[i]
+                rows, cols = np.nonzero(matched[b])
+                order = np.argsort(ranks[b, rows, cols])
+                alignments[i] = [
+                    (rowsA[x], rowsB[y], sims[x, y])
+                    for x, y in zip(rows[order], cols[order])
+                ]
+    return alignments
+
 
 def create_inter_paired_rows_dict(
     sequences_scores,
     tag,
     chain_ids: List[str] = ['A', 'B'],
 ) -> Mapping[str, List[int]]:
-
+    """Pair rows by matching the inter chain similarities of each species
+    Args:
+        sequences_scores: ragged arrays of EsmScoring.score_inter_sequences
+    """
     paired_rows_dict = {chain_id: [0] for chain_id in chain_ids}
     pair_scores = [1e6]
-    for spec, info in sequences_scores.items():
+    rows_a, offsets_a = sequences_scores['rowsA'], sequences_scores['rowsA_offsets']
+    rows_b, offsets_b = sequences_scores['rowsB'], sequences_scores['rowsB_offsets']
+    sims, offsets_sims = sequences_scores['sims'], sequences_scores['sims_offsets']
+    species_sims = []
+    for i, spec in enumerate(sequences_scores['species']):
         if spec == b'':
             continue
-        rowsA, rowsB, sims = info['rowsA'], info['rowsB'], info['sims']
-
-        alignments, num_seqs = find_alignment(rowsA, rowsB, sims, tag)        
-
+        rowsA = rows_a[offsets_a[i]:offsets_a[i + 1]]
+        rowsB = rows_b[offsets_b[i]:offsets_b[i + 1]]
+        species_sims.append((
+            rowsA, rowsB,
+            sims[offsets_sims[i]:offsets_sims[i + 1]].reshape(len(rowsA), len(rowsB)),
+        ))
+    for alignments in find_alignments(species_sims, tag):
         paired_rows_dict['A'] += [_[0] for _ in alignments]
         paired_rows_dict['B'] += [_[1] for _ in alignments]
         pair_scores += [_[2] for _ in alignments]
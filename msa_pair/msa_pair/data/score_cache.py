@@ -0,0 +1,109 @@
+import time
+import sqlite3
+import hashlib
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+def hash_file(path: str) -> str:
+    """Hash the content of a file, e.g. a chain's uniref90.a3m
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_rows(rows: Sequence[int]) -> str:
+    return hashlib.sha1(np.asarray(rows, dtype=np.int64).tobytes()).hexdigest()
+
+
+def make_key(
+    msa_hash: str, rows: Sequence[int], max_num_msas: int, tag: str
+) -> str:
+    """Key of the scores of one chain in one MsaBlock: the chain MSA content,
+    the rows in the block, the block depth and the metric
+    """
+    return f'{msa_hash}:{hash_rows(rows)}:{max_num_msas}:{tag}'
+
+
+class ScoreCache:
+    """Content-addressed store of per-row scores backed by SQLite.
+    The least recently used entries are evicted once the stored scores
+    exceed max_size_bytes.
+    """
+    def __init__(self, path: str, max_size_bytes: int = 1 << 30):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS scores ('
+            'key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS scores_last_access '
+            'ON scores (last_access)'
+        )
+        self.conn.commit()
+        self.total_size, = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM scores'
+        ).fetchone()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        row = self.conn.execute(
+            'SELECT value FROM scores WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            'UPDATE scores SET last_access = ? WHERE key = ?',
+            (time.time(), key)
+        )
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, key: str, scores: np.ndarray):
+        value = np.asarray(scores, dtype=np.float32).tobytes()
+        row = self.conn.execute(
+            'SELECT size FROM scores WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None:
+            self.total_size -= row[0]
+        self.conn.execute(
+            'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+            (key, value, len(value), time.time())
+        )
+        self.total_size += len(value)
+        self._evict()
+
+    def _evict(self):
+        if self.total_size <= self.max_size_bytes:
+            return
+        # walk the least recently used entries only until enough is freed
+        num_evicted, freed = 0, 0
+        cursor = self.conn.execute(
+            'SELECT size FROM scores ORDER BY last_access, rowid'
+        )
+        for size, in cursor:
+            num_evicted += 1
+            freed += size
+            if self.total_size - freed <= self.max_size_bytes:
+                break
+        cursor.close()
+        self.conn.execute(
+            'DELETE FROM scores WHERE key IN '
+            '(SELECT key FROM scores ORDER BY last_access, rowid LIMIT ?)',
+            (num_evicted,)
+        )
+        self.total_size -= freed
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
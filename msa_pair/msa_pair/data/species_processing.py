@@ -1,93 +1,290 @@
 import os
 import json
+import re
+import heapq
 import time
+import hashlib
 from tqdm import tqdm
-from typing import Sequence, Dict
+from typing import Sequence, Dict, List, TYPE_CHECKING
 from collections import defaultdict
 
 import numpy as np
-import pandas as pd
 
 from alphafold.data import parsers, pipeline, msa_identifiers, msa_pairing
 from alphafold.common import residue_constants
 
 from msa_pair.data import msa_processing
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+
+# HHBLITS_AA_TO_ID as a lookup table over ASCII codes, 255 for unknown codes
+_HHBLITS_AA_LUT = np.full(256, 255, dtype=np.uint8)
+for _res, _res_id in residue_constants.HHBLITS_AA_TO_ID.items():
+    _HHBLITS_AA_LUT[ord(_res)] = _res_id
+
+
+# UniRef90 headers end with "n=3 Tax=Homininae TaxID=207598 RepID=..."
+_UNIREF_TAXID_PATTERN = re.compile(r'TaxID=(\d+)')
 
 
 def get_uniref_species(description):
-    temp = description[1:]
-    if temp.find('TaxID=')!=-1:
-        n_index = temp.index('n=')
-        temp = temp[n_index:].split(maxsplit=1)[-1]
-        TaxID_index = temp.index('TaxID=')
-        Tax,[TaxID,RepID] = temp[:TaxID_index].strip(),temp[TaxID_index:].split()
-        Tax = Tax.split('=')[1]
-        TaxID = int(TaxID.split('=')[1])
-        RepID = RepID.split('=')[1]
-        return str(TaxID)
-    else:
+    matches = _UNIREF_TAXID_PATTERN.search(description)
+    if matches is None:
         return ''
+    return str(int(matches.group(1)))
 
-def make_msa_features(msas: Sequence[parsers.Msa]):
-    """Constructs a feature dict of MSA features."""
+
+def get_species_ids(
+    descriptions: Sequence[str], species_source: str = 'uniref'
+) -> List[bytes]:
+    """Extract the species identifiers of all descriptions in one pass
+    Args:
+        species_source: 'uniref' for the TaxID of UniRef headers, 'uniprot'
+            for the species mnemonic of UniProtKB headers (tr|...|..._HUMAN)
+    """
+    if species_source == 'uniref':
+        search = _UNIREF_TAXID_PATTERN.search
+        all_matches = map(search, descriptions)
+        return [
+            b'' if matches is None else str(int(matches.group(1))).encode()
+            for matches in all_matches
+        ]
+    elif species_source == 'uniprot':
+        return [
+            msa_identifiers.get_identifiers(desc).species_id.encode('utf-8')
+            for desc in descriptions
+        ]
+    else:
+        raise ValueError(f"No such species source: {species_source}!")
+
+
+def make_msa_features(
+    msas: Sequence[parsers.Msa],
+    species_source: str = 'uniref',
+    compact: bool = False,
+):
+    """Constructs a feature dict of MSA features.
+    With compact, the features use the layout of compact_msa_features.
+    """
     if not msas:
       raise ValueError('At least one MSA must be provided.')
 
-    int_msa = []
-    deletion_matrix = []
-    species_ids = []
-    seen_sequences = set()
-    sequences = []
-    descriptions = []
+    all_sequences = []
+    all_deletion_matrix = []
+    all_descriptions = []
     for msa_index, msa in enumerate(msas):
         if not msa:
             raise ValueError(
                 f'MSA {msa_index} must contain at least one sequence.'
             )
-        for sequence_index, sequence in enumerate(msa.sequences):
-            if sequence in seen_sequences:
-                continue
-            seen_sequences.add(sequence)
-            int_msa.append(
-                [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence]
-            )
-            
-            #--------------------------------------------------------------------
-            # # for MSA searched from uniprotKB
-            # identifiers = msa_identifiers.get_identifiers(
-            #     msa.descriptions[sequence_index]
-            # )
-            # species_ids.append(identifiers.species_id.encode('utf-8'))
-
-            
-            # for MSA seached from uniref
-            species_idf = get_uniref_species(msa.descriptions[sequence_index]) 
-            species_ids.append(species_idf.encode('utf-8'))
-            
-            #--------------------------------------------------------------------
-            
-            deletion_matrix.append(msa.deletion_matrix[sequence_index])
-            sequences.append(sequence)
-            descriptions.append(msa.descriptions[sequence_index])
+        all_sequences += msa.sequences
+        all_deletion_matrix += msa.deletion_matrix
+        all_descriptions += msa.descriptions
+
+    num_res = len(all_sequences[0])
+    if any(len(sequence) != num_res for sequence in all_sequences):
+        raise ValueError('All aligned sequences must have the same length.')
+    char_msa = np.frombuffer(
+        ''.join(all_sequences).encode('ascii'), dtype=np.uint8
+    ).reshape(len(all_sequences), num_res)
+
+    # keep the first occurrence of each sequence, comparing whole rows at once
+    row_keys = np.ascontiguousarray(char_msa).view(
+        np.dtype((np.void, num_res))
+    ).ravel()
+    _, first_rows = np.unique(row_keys, return_index=True)
+    keep_rows = np.sort(first_rows)
+
+    int_msa = _HHBLITS_AA_LUT[char_msa[keep_rows]]
+    if (int_msa == 255).any():
+        raise ValueError('Unknown residue in the MSA.')
+    sequences = [all_sequences[i] for i in keep_rows]
+    deletion_matrix = [all_deletion_matrix[i] for i in keep_rows]
+    descriptions = [all_descriptions[i] for i in keep_rows]
+
+    species_ids = get_species_ids(descriptions, species_source)
 
     processed_msa = parsers.Msa(
         sequences=sequences,
         descriptions=descriptions,
         deletion_matrix=deletion_matrix,
     )
+    features = _make_features(int_msa, deletion_matrix, species_ids, compact)
+
+    return features, processed_msa
 
-    num_res = len(msas[0].sequences[0])
-    num_alignments = len(int_msa)
+
+def _make_features(int_msa, deletion_matrix, species_ids, compact=False):
+    """Feature dict of the uint8 residue codes, deletion rows and species ids
+    of an MSA. With compact, the arrays are built directly in the layout of
+    compact_msa_features, without full int32 or object arrays on the way.
+    """
+    num_alignments, num_res = int_msa.shape
     features = {}
-    features['deletion_matrix_int'] = np.array(
-        deletion_matrix, dtype=np.int32
-    )
-    features['msa'] = np.array(int_msa, dtype=np.int32)
+    if compact:
+        deletions = np.empty((num_alignments, num_res), dtype=np.uint8)
+        for i, row in enumerate(deletion_matrix):
+            deletions[i] = np.minimum(row, 255)
+        vocab, codes = np.unique(
+            np.asarray(species_ids, dtype=np.bytes_), return_inverse=True
+        )
+        features['deletion_matrix_int'] = deletions
+        features['msa'] = int_msa.astype(np.uint8, copy=False)
+    else:
+        features['deletion_matrix_int'] = np.array(
+            deletion_matrix, dtype=np.int32
+        )
+        features['msa'] = np.array(int_msa, dtype=np.int32)
     features['num_alignments'] = np.array(
         [num_alignments] * num_res, dtype=np.int32)
-    features['msa_species_identifiers'] = np.array(
-        species_ids, dtype=np.object_
+    if compact:
+        features['msa_species_identifiers'] = codes.astype(np.int32)
+        features['msa_species_vocab'] = vocab
+    else:
+        features['msa_species_identifiers'] = np.array(
+            species_ids, dtype=np.object_
+        )
+    return features
+
+
+def compact_msa_features(msa_feat):
+    """Store MSA features with small dtypes: uint8 residue codes, deletion
+    counts clipped to 255 as uint8 (2/pi*arctan(d/3) is already within 1% of
+    its limit there), and species as int32 codes into msa_species_vocab.
+    """
+    if 'msa_species_vocab' in msa_feat:
+        return msa_feat
+    msa_feat = dict(msa_feat)
+    msa_feat['msa'] = msa_feat['msa'].astype(np.uint8)
+    msa_feat['deletion_matrix_int'] = np.minimum(
+        msa_feat['deletion_matrix_int'], 255
+    ).astype(np.uint8)
+    vocab, codes = np.unique(
+        np.asarray(msa_feat['msa_species_identifiers'], dtype=np.bytes_),
+        return_inverse=True,
+    )
+    msa_feat['msa_species_identifiers'] = codes.astype(np.int32)
+    msa_feat['msa_species_vocab'] = vocab
+    return msa_feat
+
+
+def expand_msa_features(msa_feat):
+    """Convert compact MSA features back to the dtypes used by alphafold
+    """
+    if 'msa_species_vocab' not in msa_feat:
+        return msa_feat
+    msa_feat = dict(msa_feat)
+    vocab = msa_feat.pop('msa_species_vocab')
+    msa_feat['msa'] = msa_feat['msa'].astype(np.int32)
+    msa_feat['deletion_matrix_int'] = \
+        msa_feat['deletion_matrix_int'].astype(np.int32)
+    msa_feat['msa_species_identifiers'] = np.array(
+        list(vocab[msa_feat['msa_species_identifiers']]), dtype=np.object_
+    )
+    return msa_feat
+
+
+def iter_a3m(path: str):
+    """Yield (description, sequence) of an a3m file one record at a time
+    """
+    description, lines = None, []
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith('>'):
+                if description is not None:
+                    yield description, ''.join(lines)
+                description, lines = line[1:], []
+            elif line:
+                lines.append(line)
+    if description is not None:
+        yield description, ''.join(lines)
+
+
+def _encode_a3m_sequence(sequence: str):
+    """Remove the insertions of an a3m sequence, returning the aligned sequence,
+    its HHblits residue codes and its deletion counts
+    """
+    codes = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    is_insertion = (codes >= ord('a')) & (codes <= ord('z'))
+    aligned = codes[~is_insertion]
+    num_insertions = np.cumsum(is_insertion)[~is_insertion]
+    deletions = np.diff(num_insertions, prepend=0)
+    int_seq = _HHBLITS_AA_LUT[aligned]
+    if (int_seq == 255).any():
+        raise ValueError(f'Unknown residue in sequence: {sequence}')
+    return aligned.tobytes().decode(), int_seq, deletions
+
+
+def stream_msa_features(
+    paths: Sequence[str],
+    take_num_seqs: int = 128,
+    gap_cutoff: float = 0.4,
+    species_source: str = 'uniref',
+    compact: bool = False,
+):
+    """Read a3m files record by record and keep only the rows that scoring can
+    use: the query, plus at most take_num_seqs rows per species with a gap
+    ratio <= gap_cutoff, the most similar to the query first. Sequences are
+    deduplicated as in make_msa_features.
+
+    Returns the features and the Msa of the kept rows, with
+    features['msa_row_index'] giving their row in the full deduplicated MSA.
+    """
+    seen_sequences = set()
+    species_heaps = defaultdict(list)
+    query = None
+    row_index = 0
+    for path in paths:
+        for description, sequence in iter_a3m(path):
+            aligned, int_seq, deletions = _encode_a3m_sequence(sequence)
+            # dedup on the aligned characters, as residue codes merge
+            # e.g. B and D or X and J
+            digest = hashlib.blake2b(aligned.encode(), digest_size=16).digest()
+            if digest in seen_sequences:
+                continue
+            seen_sequences.add(digest)
+            record = (row_index, description, aligned, int_seq, deletions)
+            row_index += 1
+            if query is None:
+                query = record
+                continue
+
+            gap = np.mean(int_seq == 21)
+            spec = get_species_ids([description], species_source)[0]
+            if spec == b'' or gap > gap_cutoff:
+                continue
+            similarity = np.mean(int_seq == query[3])
+            # min-heap that evicts the least similar, then the latest row
+            heap = species_heaps[spec]
+            heapq.heappush(heap, (similarity, -record[0], spec, record))
+            if len(heap) > take_num_seqs:
+                heapq.heappop(heap)
+
+    if query is None:
+        raise ValueError('At least one sequence must be provided.')
+
+    kept = [(query, get_species_ids([query[1]], species_source)[0])]
+    for heap in species_heaps.values():
+        kept += [(record, spec) for _, _, spec, record in heap]
+    kept.sort(key=lambda v: v[0][0])
+
+    processed_msa = parsers.Msa(
+        sequences=[record[2] for record, _ in kept],
+        deletion_matrix=[record[4].tolist() for record, _ in kept],
+        descriptions=[record[1] for record, _ in kept],
+    )
+    features = _make_features(
+        np.stack([record[3] for record, _ in kept]),
+        [record[4] for record, _ in kept],
+        [spec for _, spec in kept],
+        compact,
+    )
+    features['msa_row_index'] = np.array(
+        [record[0] for record, _ in kept], dtype=np.int64
     )
 
     return features, processed_msa
@@ -96,6 +293,8 @@ def make_msa_features(msas: Sequence[parsers.Msa]):
 def make_msa_df(chain_features):
     """Construct DataFrame for species processing
     """
+    import pandas as pd
+
     chain_msa = chain_features['msa']
     # print(chain_msa)
     # exit()
@@ -115,20 +314,100 @@ def make_msa_df(chain_features):
     return msa_df
 
 
-def create_species_dict(msa_df: pd.DataFrame) -> Dict[bytes, pd.DataFrame]:
+def create_species_dict(msa_df: 'pd.DataFrame') -> Dict[bytes, 'pd.DataFrame']:
     species_lookup = {}
     for species, species_df in msa_df.groupby('msa_species_identifiers'):
         species_lookup[species] = species_df
     return species_lookup
 
 
+class SpeciesRows:
+    """Rows of one species in one chain, sorted by decreasing similarity to
+    the query. The arrays are views into the chain's SpeciesIndex.
+    """
+    __slots__ = ('msa_row', 'msa_similarity', 'gap')
+
+    def __init__(self, msa_row, msa_similarity, gap):
+        self.msa_row = msa_row
+        self.msa_similarity = msa_similarity
+        self.gap = gap
+
+    def __len__(self):
+        return len(self.msa_row)
+
+
+class SpeciesIndex:
+    """Rows of one chain grouped by species in CSR layout: the rows of
+    species[i] are msa_row[offsets[i]:offsets[i + 1]], sorted by decreasing
+    similarity (ties keep the MSA order). msa_similarity and gap are
+    aligned with msa_row.
+    """
+    def __init__(self, species_ids, msa_similarity, gap):
+        if species_ids.dtype == np.object_:
+            species_ids = np.asarray(species_ids, dtype=np.bytes_)
+        self.species, species_codes = np.unique(
+            species_ids, return_inverse=True
+        )
+        self.msa_row = np.lexsort((-msa_similarity, species_codes))
+        self.offsets = np.zeros(len(self.species) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(species_codes, minlength=len(self.species)),
+            out=self.offsets[1:]
+        )
+        self.species_codes = species_codes
+        self.msa_similarity = msa_similarity[self.msa_row]
+        self.gap = gap[self.msa_row]
+
+    def __len__(self):
+        return len(self.species)
+
+    def get_rows(self, i: int) -> SpeciesRows:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return SpeciesRows(
+            self.msa_row[start:end],
+            self.msa_similarity[start:end],
+            self.gap[start:end],
+        )
+
+
+def make_species_index(chain_features) -> SpeciesIndex:
+    """Construct the SpeciesIndex of a chain, without pandas
+    """
+    chain_msa = chain_features['msa']
+    query_seq = chain_msa[0]
+    per_seq_similarity = np.sum(
+        query_seq[None] == chain_msa, axis=-1
+    ) / float(len(query_seq))
+    per_seq_gap = np.sum(chain_msa == 21, axis=-1) / float(len(query_seq))
+    species_index = SpeciesIndex(
+        chain_features['msa_species_identifiers'],
+        per_seq_similarity,
+        per_seq_gap,
+    )
+    if 'msa_species_vocab' in chain_features:
+        # compact features: species are codes into a sorted vocabulary
+        species_index.species = \
+            chain_features['msa_species_vocab'][species_index.species]
+    return species_index
+
+
 def parse(
     input_dir: str,
     names: Sequence[str],
     chain_ids=['A', 'B'], 
     pair_species=False,
+    species_source='uniref',
+    take_num_seqs=None,
+    gap_cutoff=0.4,
+    compact=False,
 ):
     """Parse all MSAs in the directory
+    Args:
+        take_num_seqs: if set, stream the a3m files and keep at most
+            take_num_seqs rows per species (see stream_msa_features)
+        compact: build the features in the layout of compact_msa_features,
+            for species grouping; the alphafold feature pipeline
+            (PairingPipeline) needs the standard layout
     """
     grouped_paths = {
         chain_id: 
@@ -144,34 +423,139 @@ def parse(
 
     msas_dict = {}
     msa_feats_dict = {}
-    if pair_species:
-        all_species_dict = defaultdict(dict)
     for chain_id, paths in grouped_paths.items():
+        if take_num_seqs is not None:
+            msa_feat, processed_msa = stream_msa_features(
+                paths, take_num_seqs, gap_cutoff, species_source, compact
+            )
+            msas_dict[chain_id] = processed_msa
+            msa_feats_dict[chain_id] = msa_feat
+            continue
+
         msas = []
         for path in paths:
             with open(path) as fh:
                 a3m_str = fh.read()
                 msa = parsers.parse_a3m(a3m_str)
             msas.append(msa)
-        msa_feat, processed_msa = make_msa_features(msas)
-
-        if pair_species:
-            msa_df = make_msa_df(msa_feat)
-            species_dict = create_species_dict(msa_df)
-            for spec, df in species_dict.items():
-                if spec == b'':
-                    continue
-                all_species_dict[spec][chain_id] = df
+        msa_feat, processed_msa = make_msa_features(
+            msas, species_source, compact
+        )
 
         msas_dict[chain_id] = processed_msa
         msa_feats_dict[chain_id] = msa_feat
     
     if pair_species:
+        all_species_dict = group_species(msa_feats_dict)
         return all_species_dict, msas_dict, msa_feats_dict
     else:
         return msas_dict, msa_feats_dict
 
 
+def group_species(msa_feats_dict):
+    """Group the rows of every chain by species
+    """
+    all_species_dict = defaultdict(dict)
+    for chain_id, msa_feat in msa_feats_dict.items():
+        species_index = make_species_index(msa_feat)
+        for i, spec in enumerate(species_index.species):
+            if spec == b'':
+                continue
+            all_species_dict[spec][chain_id] = species_index.get_rows(i)
+    return all_species_dict
+
+
+def hash_a3m_files(paths: Sequence[str], **parse_options) -> str:
+    """Hash the content of the a3m files of a chain and the options they are
+    parsed with, to tell whether a file saved by save_parsed is outdated
+    """
+    sha1 = hashlib.sha1(json.dumps(parse_options, sort_keys=True).encode())
+    for path in paths:
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def save_parsed(dst_path, msas_dict, msa_feats_dict, a3m_hashes=None):
+    """Save parsed MSAs and their features to a npz file, so that later stages
+    can skip parsing the a3m files
+    Args:
+        a3m_hashes: hash_a3m_files of each chain, saved with the MSAs
+    """
+    arrays = {}
+    for chain_id, msa in msas_dict.items():
+        msa_feat = msa_feats_dict[chain_id]
+        arrays[f'{chain_id}/sequences'] = np.array(msa.sequences, dtype=np.bytes_)
+        arrays[f'{chain_id}/descriptions'] = np.array(
+            [desc.encode('utf-8') for desc in msa.descriptions], dtype=np.bytes_
+        )
+        msa_feat = expand_msa_features(msa_feat)
+        arrays[f'{chain_id}/deletion_matrix'] = np.array(
+            msa.deletion_matrix, dtype=np.int32
+        )
+        arrays[f'{chain_id}/msa'] = msa_feat['msa'].astype(np.uint8)
+        arrays[f'{chain_id}/msa_species_identifiers'] = np.array(
+            msa_feat['msa_species_identifiers'], dtype=np.bytes_
+        )
+        if 'msa_row_index' in msa_feat:
+            arrays[f'{chain_id}/msa_row_index'] = msa_feat['msa_row_index']
+        if a3m_hashes is not None:
+            arrays[f'{chain_id}/a3m_hash'] = np.array(a3m_hashes[chain_id])
+    with open(dst_path, 'wb') as fh:
+        np.savez(fh, **arrays)
+
+
+def load_parsed(src_path, compact=False):
+    """Load the MSAs and features saved by save_parsed
+    """
+    msas_dict = {}
+    msa_feats_dict = {}
+    with np.load(src_path) as data:
+        chain_ids = sorted(set(key.split('/')[0] for key in data.files))
+        for chain_id in chain_ids:
+            deletion_matrix = data[f'{chain_id}/deletion_matrix']
+            msa = data[f'{chain_id}/msa'].astype(np.int32)
+            msas_dict[chain_id] = parsers.Msa(
+                sequences=[
+                    seq.decode() for seq in data[f'{chain_id}/sequences']
+                ],
+                deletion_matrix=deletion_matrix.tolist(),
+                descriptions=[
+                    desc.decode('utf-8')
+                    for desc in data[f'{chain_id}/descriptions']
+                ],
+            )
+            msa_feats_dict[chain_id] = {
+                'deletion_matrix_int': deletion_matrix,
+                'msa': msa,
+                'num_alignments': np.array(
+                    [msa.shape[0]] * msa.shape[1], dtype=np.int32
+                ),
+                'msa_species_identifiers': np.array(
+                    list(data[f'{chain_id}/msa_species_identifiers']),
+                    dtype=np.object_
+                ),
+            }
+            if f'{chain_id}/msa_row_index' in data.files:
+                msa_feats_dict[chain_id]['msa_row_index'] = \
+                    data[f'{chain_id}/msa_row_index']
+            if compact:
+                msa_feats_dict[chain_id] = compact_msa_features(
+                    msa_feats_dict[chain_id]
+                )
+    return msas_dict, msa_feats_dict
+
+
+def load_parsed_hashes(src_path):
+    """The a3m_hashes saved by save_parsed, by chain"""
+    with np.load(src_path) as data:
+        return {
+            key.split('/')[0]: str(data[key])
+            for key in data.files if key.endswith('/a3m_hash')
+        }
+
+
 def parse_pairs(
     pairs: list,
     pair_species=False,
@@ -180,8 +564,6 @@ def parse_pairs(
     msa_feats_dict = {}
     chain_ids = ["A", "B"]
 
-    if pair_species:
-        all_species_dict = defaultdict(dict)
     for i in range(2): # 0 or 1
         chain_id = chain_ids[i]
         msas = []
@@ -192,18 +574,11 @@ def parse_pairs(
         msas.append(parsers.convert_seq_desc_to_Msa(sequences, descriptions))
         msa_feat, processed_msa = make_msa_features(msas)
 
-        if pair_species:
-            msa_df = make_msa_df(msa_feat)
-            species_dict = create_species_dict(msa_df)
-            for spec, df in species_dict.items():
-                if spec == b'':
-                    continue
-                all_species_dict[spec][chain_id] = df
-
         msas_dict[chain_id] = processed_msa
         msa_feats_dict[chain_id] = msa_feat
     
     if pair_species:
+        all_species_dict = group_species(msa_feats_dict)
         return all_species_dict, msas_dict, msa_feats_dict
     else:
         return msas_dict, msa_feats_dict
@@ -213,13 +588,54 @@ def pair_species(
     input_dir: str,
     names: Sequence[str] = ['uniprot.a3m'],
     chain_ids=['A', 'B'],
+    parsed_path: str = None,
+    species_source: str = 'uniref',
+    take_num_seqs: int = None,
+    gap_cutoff: float = 0.4,
+    compact: bool = False,
 ):
-    all_species_dict, msas_dict, msa_feats_dict = parse(
-        input_dir,
-        names,
-        chain_ids=chain_ids,
-        pair_species=True,
-    )
+    """Parse the MSAs and keep the species found in all chains
+    Args:
+        parsed_path: npz file of the parsed MSAs. It is loaded instead of the
+            a3m files if it exists and was parsed from the same a3m files
+            with the same options, and written after parsing otherwise.
+        species_source: header convention of the MSAs, 'uniref' or 'uniprot'
+        take_num_seqs: if set, stream the a3m files and only keep the rows
+            that scoring uses. msa_feats_dict[chain_id]['msa_row_index'] then
+            maps the kept rows back to the full MSA.
+        compact: keep the features in the layout of compact_msa_features,
+            see parse
+    """
+    a3m_hashes = None
+    if parsed_path is not None:
+        paths = {
+            chain_id: [os.path.join(input_dir, chain_id, name) for name in names]
+            for chain_id in chain_ids
+        }
+        if all(os.path.exists(path) for v in paths.values() for path in v):
+            a3m_hashes = {
+                chain_id: hash_a3m_files(
+                    paths_, species_source=species_source,
+                    take_num_seqs=take_num_seqs, gap_cutoff=gap_cutoff,
+                ) for chain_id, paths_ in paths.items()
+            }
+    if a3m_hashes is not None and os.path.exists(parsed_path) and \
+            load_parsed_hashes(parsed_path) == a3m_hashes:
+        msas_dict, msa_feats_dict = load_parsed(parsed_path, compact=compact)
+        all_species_dict = group_species(msa_feats_dict)
+    else:
+        all_species_dict, msas_dict, msa_feats_dict = parse(
+            input_dir,
+            names,
+            chain_ids=chain_ids,
+            pair_species=True,
+            species_source=species_source,
+            take_num_seqs=take_num_seqs,
+            gap_cutoff=gap_cutoff,
+            compact=compact,
+        )
+        if parsed_path is not None:
+            save_parsed(parsed_path, msas_dict, msa_feats_dict, a3m_hashes)
 
     matched_species_dict = {}
     for spec, dfs in all_species_dict.items():
@@ -253,7 +669,7 @@ def process_paired_msas(matched_species_dict, msas_dict):
     for chain_id, msa in msas_dict.items():
         rows = []
         for spec, dfs in matched_species_dict.items():
-            rows += list(dfs[chain_id].msa_row.values)
+            rows += list(dfs[chain_id].msa_row)
         rows = sorted(rows)
         if 0 not in rows:
             rows = [0] + rows
@@ -138,9 +138,26 @@ class MSATransformer(nn.Module):
             weight=self.embed_tokens.weight,
         )
 
-    def forward(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False):
+    def forward(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False,
+                need_query_col_attn=False, scoring_only=False, last_layer=None):
+        """
+        need_query_col_attn: only keep the column attention between the first
+            (query) row and every row, A[0, j] + A[j, 0] summed over heads and
+            layers, returned as "query_col_attentions" (B x C x R). The R x R
+            column attention is then never stored.
+        scoring_only: need_query_col_attn without the lm_head, no "logits"
+            are returned
+        last_layer: in scoring_only mode, stop after this many layers
+        """
         if return_contacts:
             need_head_weights = True
+        if scoring_only:
+            need_query_col_attn = True
+        if need_query_col_attn:
+            need_head_weights = False
+        layers = self.layers
+        if scoring_only and last_layer is not None:
+            layers = layers[:last_layer]
 
         assert tokens.ndim == 3
         batch_size, num_alignments, seqlen = tokens.size()
@@ -177,12 +194,23 @@ class MSATransformer(nn.Module):
         # B x R x C x D -> R x C x B x D
         x = x.permute(1, 2, 0, 3)
 
-        for layer_idx, layer in enumerate(self.layers):
-            x = layer(
-                x,
-                self_attn_padding_mask=padding_mask,
-                need_head_weights=need_head_weights,
-            )
+        for layer_idx, layer in enumerate(layers):
+            if need_query_col_attn:
+                x, query_col_attn = axial_layer_query_forward(
+                    layer, x, self_attn_padding_mask=padding_mask,
+                )
+                # H x C x B x R -> B x C x R
+                query_col_attn = query_col_attn.sum(0).permute(1, 0, 2)
+                if layer_idx == 0:
+                    query_col_attn_weights = query_col_attn
+                else:
+                    query_col_attn_weights += query_col_attn
+            else:
+                x = layer(
+                    x,
+                    self_attn_padding_mask=padding_mask,
+                    need_head_weights=need_head_weights,
+                )
             # if need_head_weights:
             #     x, col_attn, row_attn = x
             #     # H x C x B x R x R -> B x H x C x R x R
@@ -201,6 +229,15 @@ class MSATransformer(nn.Module):
             if (layer_idx + 1) in repr_layers:
                 hidden_representations[layer_idx + 1] = x.permute(2, 0, 1, 3)
 
+        if scoring_only:
+            if (layer_idx + 1) in repr_layers:
+                x = self.emb_layer_norm_after(x)
+                hidden_representations[layer_idx + 1] = x.permute(2, 0, 1, 3)
+            return {
+                "representations": hidden_representations,
+                "query_col_attentions": query_col_attn_weights,
+            }
+
         x = self.emb_layer_norm_after(x)
         x = x.permute(2, 0, 1, 3)  # R x C x B x D -> B x R x C x D
 
@@ -210,6 +247,9 @@ class MSATransformer(nn.Module):
         x = self.lm_head(x)
 
         result = {"logits": x, "representations": hidden_representations}
+        if need_query_col_attn:
+            # B x C x R
+            result["query_col_attentions"] = query_col_attn_weights
         if need_head_weights:
             
             # # col_attentions: B x L x H x C x R x R
@@ -249,4 +289,76 @@ class MSATransformer(nn.Module):
 
 def symmetrize(x):
     "Make layer symmetric in final two dimensions, used for contact prediction."
-    return x + x.transpose(-1, -2)
\ No newline at end of file
+    return x + x.transpose(-1, -2)
+
+
+def column_query_attention(module, x, self_attn_padding_mask=None):
+    """Column self-attention of a ColumnSelfAttention module that only returns
+    the attention between the query row and every row, A[0, j] + A[j, 0]
+    (H x C x B x R). As in ColumnSelfAttention, the attention weights are
+    computed in chunks of about module.max_tokens_per_msa x R per head. When
+    max_tokens_per_msa is below R, query rows are chunked too, and no R x R
+    tensor is kept across chunks.
+    """
+    num_rows, num_cols, batch_size, embed_dim = x.size()
+    num_heads, head_dim = module.num_heads, module.head_dim
+    if num_rows == 1:
+        query_attn = x.new_full((num_heads, num_cols, batch_size, 1), 2.0)
+        return module.out_proj(module.v_proj(x)), query_attn
+
+    q = module.q_proj(x).view(num_rows, num_cols, batch_size, num_heads, head_dim)
+    k = module.k_proj(x).view(num_rows, num_cols, batch_size, num_heads, head_dim)
+    v = module.v_proj(x).view(num_rows, num_cols, batch_size, num_heads, head_dim)
+    q *= module.scaling
+
+    max_cols = max(1, module.max_tokens_per_msa // num_rows)
+    max_rows = max(1, module.max_tokens_per_msa // min(max_cols, num_cols))
+    contexts = []
+    query_attns = []
+    for col_start in range(0, num_cols, max_cols):
+        cols = slice(col_start, col_start + max_cols)
+        padding_mask = None
+        if self_attn_padding_mask is not None:
+            # B x R x C -> 1 x C x B x 1 x R
+            padding_mask = self_attn_padding_mask[:, :, cols].permute(2, 0, 1)
+            padding_mask = padding_mask.unsqueeze(0).unsqueeze(3)
+        row_contexts = []
+        attn_to_query = []
+        for row_start in range(0, num_rows, max_rows):
+            rows = slice(row_start, row_start + max_rows)
+            attn_weights = torch.einsum(
+                "icnhd,jcnhd->hcnij", q[rows, cols], k[:, cols]
+            )
+            if padding_mask is not None:
+                attn_weights = attn_weights.masked_fill(padding_mask, -10000)
+            attn_probs = attn_weights.softmax(-1)
+            row_contexts.append(
+                torch.einsum("hcnij,jcnhd->icnhd", attn_probs, v[:, cols])
+            )
+            if row_start == 0:
+                query_row_attn = attn_probs[..., 0, :]
+            attn_to_query.append(attn_probs[..., 0])
+        contexts.append(torch.cat(row_contexts, 0))
+        query_attns.append(query_row_attn + torch.cat(attn_to_query, -1))
+
+    context = torch.cat(contexts, 1).contiguous()
+    context = context.view(num_rows, num_cols, batch_size, embed_dim)
+    return module.out_proj(context), torch.cat(query_attns, 1)
+
+
+def axial_layer_query_forward(layer, x, self_attn_padding_mask=None):
+    """AxialTransformerLayer forward that returns the query row column attention
+    of column_query_attention instead of the full head weights
+    """
+    x, _ = layer.row_self_attention(
+        x, self_attn_padding_mask=self_attn_padding_mask,
+    )
+    column_block = layer.column_self_attention
+    residual = x
+    x, query_attn = column_query_attention(
+        column_block.layer, column_block.layer_norm(x),
+        self_attn_padding_mask=self_attn_padding_mask,
+    )
+    x = residual + column_block.dropout_module(x)
+    x = layer.feed_forward_layer(x)
+    return x, query_attn